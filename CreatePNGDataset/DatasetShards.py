@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sharded storage for exported 2D slices.
+
+Slices are stored as .npy members of uncompressed tar shards (shard_00000.tar, ...),
+N slices per shard, next to an append-only manifest.jsonl with one record per slice.
+Each record carries the naming metadata (subject, series, slice index, orientation),
+the unwrap min/max when available, and the byte offset of the array inside its shard,
+so loaders can read shards sequentially or seek straight to a slice.
+
+Usage:
+    with ShardWriter(folder, shard_size=256) as writer:
+        writer.add("MWALiver_2D_P_Pig2_71s5", array, {"subject": "Pig2", "series": 71})
+
+    for record, array in iter_shard_records(folder):
+        ...
+"""
+
+import io
+import json
+import os
+import re
+import tarfile
+import numpy as np
+
+MANIFEST_NAME = "manifest.jsonl"
+SHARD_PATTERN = "shard_{:05d}.tar"
+
+# Naming convention of SaveSliceAsPng.py: <prefix>_<subject>_<series>s<slice>.png (or .npy)
+SLICE_FILENAME_RE = re.compile(r"^(?P<prefix>.+?_2D_[A-Z])_(?P<subject>.+)_(?P<series>\d+|None)(?:_(?P<axis>[IJ]))?s(?P<slice>\d+)\.(png|npy)$")
+
+def parse_slice_filename(filename):
+    """
+    Extract prefix, subject, series, normal axis and slice index from an exported slice filename.
+
+    Returns:
+        dict: Keys 'prefix', 'subject', 'series', 'normal_axis' ('I', 'J' or 'K'; names without
+              an axis tag are K slices) and 'slice_index' (None where not parseable).
+    """
+    match = SLICE_FILENAME_RE.match(os.path.basename(filename))
+    if not match:
+        return {"prefix": None, "subject": None, "series": None, "normal_axis": None, "slice_index": None}
+    series = match.group("series")
+    return {
+        "prefix": match.group("prefix"),
+        "subject": match.group("subject"),
+        "series": int(series) if series.isdigit() else None,
+        "normal_axis": match.group("axis") or "K",
+        "slice_index": int(match.group("slice")),
+    }
+
+def record_id(record):
+    """Identity of a sample: its source file when recorded, else its key."""
+    return record.get("source") or record["key"]
+
+def read_manifest(folder, latest_only=False):
+    """
+    Return the list of manifest records in 'folder' (empty if there is none).
+
+    A sample rewritten later (changed input, or a crash before the caller recorded it) has
+    several records; latest_only keeps only the last one per sample, in manifest order.
+    """
+    manifest_path = os.path.join(folder, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return []
+    with open(manifest_path, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if latest_only:
+        last = {record_id(r): i for i, r in enumerate(records)}
+        records = [r for i, r in enumerate(records) if last[record_id(r)] == i]
+    return records
+
+def read_manifest_tail(folder, max_records, block_size=1 << 16):
+    """
+    Return up to the last 'max_records' manifest records, reading the file backwards so the
+    cost does not grow with the size of the dataset.
+    """
+    manifest_path = os.path.join(folder, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return []
+    with open(manifest_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        # One extra line so the first kept line is complete
+        while pos > 0 and data.count(b"\n") <= max_records + 1:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = [line for line in data.splitlines() if line.strip()]
+    if pos > 0:
+        lines = lines[1:]
+    return [json.loads(line) for line in lines[-max_records:]]
+
+def compact_manifest(folder):
+    """
+    Atomically rewrite the manifest with only the latest record per sample.
+    Superseded members stay in their shards but are no longer referenced.
+
+    Returns:
+        int: Number of records dropped.
+    """
+    manifest_path = os.path.join(folder, MANIFEST_NAME)
+    all_records = read_manifest(folder)
+    records = read_manifest(folder, latest_only=True)
+    if len(records) == len(all_records):
+        return 0
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    os.replace(tmp_path, manifest_path)
+    return len(all_records) - len(records)
+
+def iter_shard_records(folder):
+    """
+    Yield (record, array) pairs in manifest order, reading each shard sequentially.
+    Only the latest record of each sample is returned.
+    """
+    records = read_manifest(folder, latest_only=True)
+    current_shard = None
+    f = None
+    try:
+        for record in records:
+            if record["shard"] != current_shard:
+                if f:
+                    f.close()
+                current_shard = record["shard"]
+                f = open(os.path.join(folder, current_shard), "rb")
+            f.seek(record["offset"])
+            yield record, np.load(io.BytesIO(f.read(record["size"])))
+    finally:
+        if f:
+            f.close()
+
+class ShardWriter:
+    """
+    Append slices to tar shards and records to the manifest.
+
+    Re-opening a folder continues the last shard until it holds 'shard_size' slices.
+    """
+
+    def __init__(self, folder, shard_size=256):
+        if shard_size < 1:
+            raise ValueError("shard_size must be at least 1.")
+        self.folder = folder
+        self.shard_size = int(shard_size)
+        os.makedirs(folder, exist_ok=True)
+
+        # Continue after the existing records (only the manifest tail is read)
+        records = read_manifest_tail(folder, self.shard_size)
+        if records:
+            last_shard = records[-1]["shard"]
+            self._shard_index = int(re.search(r"(\d+)", last_shard).group(1))
+            self._shard_count = sum(1 for r in records if r["shard"] == last_shard)
+        else:
+            self._shard_index = 0
+            self._shard_count = 0
+
+        self._tar = None
+        self._manifest = open(os.path.join(folder, MANIFEST_NAME), "a")
+
+    def _open_shard(self):
+        if self._shard_count >= self.shard_size:
+            self._shard_index += 1
+            self._shard_count = 0
+        shard_path = os.path.join(self.folder, SHARD_PATTERN.format(self._shard_index))
+        # PAX headers: member names are not limited to 100 characters (long subject names)
+        self._tar = tarfile.open(shard_path, "a" if os.path.isfile(shard_path) else "w", format=tarfile.PAX_FORMAT)
+
+    def add(self, key, array, metadata=None):
+        """
+        Store one slice.
+
+        Parameters:
+            key (str): Unique record name (e.g. the PNG filename without extension).
+            array (numpy.ndarray): 2D slice data; stored as-is in .npy format.
+            metadata (dict): Extra manifest fields (subject, series, slice_index, orientation,
+                             unwrapped_min, unwrapped_max, ...).
+
+        Returns:
+            dict: The manifest record written for this slice.
+        """
+        if self._tar is None or self._shard_count >= self.shard_size:
+            if self._tar is not None:
+                self._tar.close()
+            self._open_shard()
+
+        buf = io.BytesIO()
+        np.save(buf, np.ascontiguousarray(array))
+        data = buf.getvalue()
+
+        info = tarfile.TarInfo(name=f"{key}.npy")
+        info.size = len(data)
+        header_size = len(info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors))
+        offset = self._tar.offset + header_size
+        self._tar.addfile(info, io.BytesIO(data))
+        self._shard_count += 1
+
+        record = {
+            "key": key,
+            "shard": SHARD_PATTERN.format(self._shard_index),
+            "offset": offset,
+            "size": len(data),
+            "shape": list(array.shape),
+            "dtype": str(array.dtype),
+        }
+        record.update(metadata or {})
+        self._manifest.write(json.dumps(record) + "\n")
+        self._manifest.flush()
+        return record
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+        if self._manifest is not None:
+            self._manifest.close()
+            self._manifest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
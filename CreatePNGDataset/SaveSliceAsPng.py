@@ -6,104 +6,270 @@ filePath = "/home/mrthermometry/SlicerScripts/SaveSliceAsPng.py"
 
 # Define the variables to pass
 script_globals = {'viewerName': 'Yellow', 'scriptPath': filePath}
+# Optional: store slices in tar shards of N slices plus a manifest instead of loose PNGs
+script_globals['shardSize'] = 256
 
 # Execute the script with the provided globals
 exec(open(filePath, encoding='utf-8').read(), script_globals)
 """
 
 import os
+import sys
+import types
 import numpy as np
 import slicer
 import vtk
 import re  # Import regex module
-from PIL import Image
+from PIL import Image, PngImagePlugin
 
-def get_subject_name(volume_node):
+def parse_series_number(volume_name):
+    """Return the leading series number of a volume name (e.g. '71 COR P' -> 71), or None."""
+    match = re.match(r"^(\d+)\D", volume_name)
+    return int(match.group(1)) if match else None
+
+# Caches and their observers live in a module kept in sys.modules: the usual invocation
+# exec()s this script with a fresh script_globals dict each time, which would lose them
+_state = sys.modules.setdefault("SaveSliceAsPng_state", types.ModuleType("SaveSliceAsPng_state"))
+
+# Volume ID -> (subject, series), invalidated by subject hierarchy item events
+_namingCache = _state.__dict__.setdefault("namingCache", {"entries": None, "shNode": None, "observers": []})
+
+def _invalidate_naming_cache(caller=None, event=None):
+    _namingCache["entries"] = None
+
+def build_naming_cache(shNode):
     """
-    Get the subject (patient) name from a given volume node.
-    
-    Parameters:
-        volume_node (vtkMRMLScalarVolumeNode): The volume node to find the subject for.
-    
+    Resolve subject and series for every scalar volume in a single hierarchy traversal.
+
+    Subjects are the direct children of the scene item; each volume below one is
+    assigned that subject's name (unless it is the volume itself).
+
     Returns:
-        str: The subject (patient) name if found, otherwise None.
+        dict: Volume node ID -> (subject name or None, series number or None).
     """
-    # Ensure a valid volume node is provided
-    if not volume_node or not volume_node.IsA("vtkMRMLScalarVolumeNode"):
-        print("Error: Invalid volume node.")
-        return None
+    entries = {}
+    subjects = vtk.vtkIdList()
+    shNode.GetItemChildren(shNode.GetSceneItemID(), subjects)
+    for s in range(subjects.GetNumberOfIds()):
+        subject_item_id = subjects.GetId(s)
+        subject_name = shNode.GetItemName(subject_item_id)
+
+        descendants = vtk.vtkIdList()
+        shNode.GetItemChildren(subject_item_id, descendants, True)
+        item_ids = [subject_item_id] + [descendants.GetId(i) for i in range(descendants.GetNumberOfIds())]
 
-    # Get the Subject Hierarchy Node
+        for item_id in item_ids:
+            node = shNode.GetItemDataNode(item_id)
+            if not node or not node.IsA("vtkMRMLScalarVolumeNode"):
+                continue
+            volume_name = node.GetName()
+            subject = subject_name if subject_name and subject_name != volume_name else None
+            entries[node.GetID()] = (subject, parse_series_number(volume_name))
+    return entries
+
+def resolve_subject_and_series(volume_node):
+    """
+    Memoized lookup of (subject name, series number) for a volume node.
+
+    The whole scene is resolved on first use and re-resolved only after the
+    subject hierarchy reports a change.
+
+    Returns:
+        (str, int): Subject name and series number; either may be None if not found.
+    """
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
     if not shNode:
         print("Error: No Subject Hierarchy found.")
-        return None
+        return None, None
 
-    # Find the Scene Node ID dynamically
-    scene_item_id = shNode.GetSceneItemID()
-    # Find the corresponding Subject Hierarchy Item ID for the volume
-    volume_item_id = shNode.GetItemByDataNode(volume_node)
-    if volume_item_id == 0:
-        print("Error: No hierarchy item found for the volume.")
-        return None
+    # Observe the (possibly new) subject hierarchy node so edits invalidate the cache
+    if _namingCache["shNode"] is not shNode:
+        for node, tag in _namingCache["observers"]:
+            node.RemoveObserver(tag)
+        # Item-level events only: the node's generic ModifiedEvent fires on most scene changes
+        events = (
+            shNode.SubjectHierarchyItemAddedEvent,
+            shNode.SubjectHierarchyItemRemovedEvent,
+            shNode.SubjectHierarchyItemModifiedEvent,
+            shNode.SubjectHierarchyItemReparentedEvent,
+        )
+        _namingCache["observers"] = [(shNode, shNode.AddObserver(e, _invalidate_naming_cache)) for e in events]
+        _namingCache["shNode"] = shNode
+        _namingCache["entries"] = None
 
-    # Traverse up the hierarchy to find the subject (patient)
-    current_item_id = volume_item_id
-    subject_item_id = None
+    if _namingCache["entries"] is None:
+        _namingCache["entries"] = build_naming_cache(shNode)
+        print(f"Resolved subject/series for {len(_namingCache['entries'])} volumes.")
 
-    while current_item_id != scene_item_id:  # Stop when reaching the Scene Node
-        parent_item_id = shNode.GetItemParent(current_item_id)
+    entry = _namingCache["entries"].get(volume_node.GetID())
+    if entry is None:
+        print(f"Error: No hierarchy item found for the volume '{volume_node.GetName()}'.")
+        return None, None
+    return entry
 
-        # If the next parent is the Scene, mark the current node as the Subject
-        if parent_item_id == scene_item_id:
-            subject_item_id = current_item_id
-            break  # Stop searching
-        
-        # Move up to the next parent
-        current_item_id = parent_item_id
 
-    # Ensure the identified subject is actually different from the volume name
-    if subject_item_id:
-        subject_name = shNode.GetItemName(subject_item_id)
+# In-plane axes whose off-axis direction cosines stay below this are treated as IJK-aligned
+IJK_AXIS_TOLERANCE = 1e-3
 
-        if subject_name and subject_name != volume_node.GetName():
-            print(f"Subject (patient) name for volume '{volume_node.GetName()}': {subject_name}")
-            return subject_name
+# Reslice pipelines per viewer (process-wide, see _state)
+_resliceCache = _state.__dict__.setdefault("resliceCache", {})
 
-    print("No subject found in the hierarchy.")
-    return None
+def get_slice_to_ijk(slice_node, volume_node):
+    """
+    Compose the slice node's SliceToRAS with the volume's RASToIJK.
 
-def get_series_number(volume_node):
+    Returns:
+        vtkMatrix4x4: Maps slice coordinates (mm, origin at the view center) to volume IJK.
     """
-    Extracts the series number from the volume node name.
-    
+    volume_ras_to_ijk = vtk.vtkMatrix4x4()
+    volume_node.GetRASToIJKMatrix(volume_ras_to_ijk)
+    slice_to_ijk = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(volume_ras_to_ijk, slice_node.GetSliceToRAS(), slice_to_ijk)
+    return slice_to_ijk
+
+def find_normal_ijk_axis(slice_to_ijk):
+    """
+    Find the IJK axis normal to the slice plane.
+
     Parameters:
-        volume_node (vtkMRMLScalarVolumeNode): The volume node to extract the series number from.
-    
+        slice_to_ijk (vtkMatrix4x4): Slice-to-IJK matrix from get_slice_to_ijk.
+
+    Returns:
+        (int, bool): The IJK axis (0=I, 1=J, 2=K) closest to the slice normal, and whether
+                     both in-plane directions are aligned with the other two IJK axes.
+    """
+    m = np.array([[slice_to_ijk.GetElement(r, c) for c in range(3)] for r in range(3)])
+    m = np.abs(m) / np.linalg.norm(m, axis=0)
+
+    normal_axis = int(np.argmax(m[:, 2]))
+    in_plane_axes = set()
+    for c in range(2):
+        major = int(np.argmax(m[:, c]))
+        if np.any(np.delete(m[:, c], major) > IJK_AXIS_TOLERANCE):
+            return normal_axis, False
+        in_plane_axes.add(major)
+
+    aligned = len(in_plane_axes) == 2 and normal_axis not in in_plane_axes
+    return normal_axis, aligned
+
+def extract_aligned_slice(volume_array, axis, index):
+    """Return a view of the (K, J, I) volume array at 'index' along IJK 'axis'."""
+    if axis == 2:
+        return volume_array[index, :, :]
+    if axis == 1:
+        return volume_array[:, index, :]
+    return volume_array[:, :, index]
+
+def aligned_slice_to_display(slice_array, normal_axis, slice_to_ijk):
+    """
+    Reorder an extract_aligned_slice view as displayed in the viewer: rows from the top of the
+    view (slice +Y) down, columns from left to right (slice +X), like to_display_orientation.
+    """
+    m = np.array([[slice_to_ijk.GetElement(r, c) for c in range(2)] for r in range(3)])
+    axis_x, axis_y = int(np.argmax(np.abs(m[:, 0]))), int(np.argmax(np.abs(m[:, 1])))
+
+    # Remaining array axes are the IJK axes in (K, J, I) order without the normal
+    array_axes = [a for a in (2, 1, 0) if a != normal_axis]
+    out = slice_array if array_axes[0] == axis_y else slice_array.T
+    if m[axis_x, 0] < 0:
+        out = out[:, ::-1]
+    if m[axis_y, 1] > 0:
+        out = out[::-1, :]
+    return out
+
+def to_display_orientation(resliced):
+    """Flip a reslice_oblique output (row 0 at slice -Y) so row 0 is the top of the view."""
+    return resliced[::-1, :]
+
+def volume_bounds_on_plane(slice_to_ijk, dims):
+    """
+    Bounding rectangle of the volume's intersection with the slice plane.
+
     Returns:
-        int: The extracted series number if found, otherwise None.
+        (ndarray, ndarray) or None: Minimum and maximum slice (x, y) in mm of the points where
+        the plane crosses the volume box (voxel centers plus the half-voxel border that
+        vtkImageReslice still samples), or None if it misses the volume.
     """
-    # Ensure a valid volume node is provided
-    if not volume_node or not volume_node.IsA("vtkMRMLScalarVolumeNode"):
-        print("Error: Invalid volume node.")
+    ijk_to_slice = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Invert(slice_to_ijk, ijk_to_slice)
+    m = np.array([[ijk_to_slice.GetElement(r, c) for c in range(4)] for r in range(3)])
+    corners = np.array([[i, j, k] for i in (-0.5, dims[0] - 0.5) for j in (-0.5, dims[1] - 0.5)
+                        for k in (-0.5, dims[2] - 0.5)])
+    pts = corners.dot(m[:, :3].T) + m[:, 3]
+
+    # Box edges join corners that differ in one IJK coordinate; keep their crossings of z = 0
+    crossings = []
+    for a in range(8):
+        for b in range(a + 1, 8):
+            if np.count_nonzero(corners[a] != corners[b]) > 1:
+                continue
+            za, zb = pts[a, 2], pts[b, 2]
+            if za == zb:
+                if za == 0:
+                    crossings.extend([pts[a, :2], pts[b, :2]])
+            elif za * zb <= 0:
+                crossings.append(pts[a, :2] + za / (za - zb) * (pts[b, :2] - pts[a, :2]))
+    if not crossings:
         return None
+    crossings = np.array(crossings)
+    return crossings.min(axis=0), crossings.max(axis=0)
 
-    # Get the volume node name
-    volume_name = volume_node.GetName()
-    
-    # Use regex to find the first continuous digit sequence before a non-numerical character
-    match = re.match(r"^(\d+)\D", volume_name)
+def reslice_oblique(viewer_name, volume_node, slice_node, slice_to_ijk):
+    """
+    Resample the volume on the slice node's plane with a cached vtkImageReslice.
+
+    The output covers the plane's intersection with the volume at the smallest voxel spacing,
+    independent of the viewer's zoom and pan. The reslice matrix is only updated when the
+    viewer's plane has moved.
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray) or (None, None): 2D array (rows along slice Y, columns
+        along slice X) and the boolean mask of its pixels inside the volume; None if the plane
+        misses the volume.
+    """
+    dims = volume_node.GetImageData().GetDimensions()
+    bounds = volume_bounds_on_plane(slice_to_ijk, dims)
+    if bounds is None:
+        return None, None
+
+    cache = _resliceCache.get(viewer_name)
+    if cache is None:
+        reslice = vtk.vtkImageReslice()
+        reslice.SetOutputDimensionality(2)
+        reslice.SetInterpolationModeToLinear()
+        reslice.SetBackgroundLevel(0)
+        axes = vtk.vtkMatrix4x4()
+        reslice.SetResliceAxes(axes)
+        cache = {"reslice": reslice, "axes": axes}
+        _resliceCache[viewer_name] = cache
+
+    reslice = cache["reslice"]
+    axes = cache["axes"]
+    if any(axes.GetElement(r, c) != slice_to_ijk.GetElement(r, c) for r in range(4) for c in range(4)):
+        axes.DeepCopy(slice_to_ijk)
+
+    spacing = min(volume_node.GetSpacing())
+    (x0, y0), (x1, y1) = bounds
+    nx = max(1, int(np.floor((x1 - x0) / spacing)) + 1)
+    ny = max(1, int(np.floor((y1 - y0) / spacing)) + 1)
 
-    if match:
-        series_number = int(match.group(1))  # Extract the matched integer
-        print(f"Series number for volume '{volume_name}': {series_number}")
-        return series_number
+    reslice.SetInputData(volume_node.GetImageData())
+    reslice.SetOutputSpacing(spacing, spacing, 1.0)
+    reslice.SetOutputOrigin(x0, y0, 0.0)
+    reslice.SetOutputExtent(0, nx - 1, 0, ny - 1, 0, 0)
+    reslice.Update()
 
-    print(f"Error: Could not extract series number from '{volume_name}'.")
-    return None
+    scalars = reslice.GetOutput().GetPointData().GetScalars()
+    resliced = vtk.util.numpy_support.vtk_to_numpy(scalars).reshape(ny, nx)
 
+    # Pixels whose IJK position lies inside the volume box (the rest is background)
+    m = np.array([[slice_to_ijk.GetElement(r, c) for c in range(4)] for r in range(3)])
+    y, x = np.mgrid[0:ny, 0:nx] * spacing
+    ijk = (x0 + x)[..., None] * m[:, 0] + (y0 + y)[..., None] * m[:, 1] + m[:, 3]
+    valid = np.all((ijk >= -0.5) & (ijk <= np.array(dims) - 0.5), axis=-1)
+    return resliced, valid
 
-def get_slice_as_16bit_png(viewer_name, script_path):
+def get_slice_as_16bit_png(viewer_name, script_path, shard_size=None):
 
     # Validate viewer name
     valid_viewers = {"Red", "Green", "Yellow"}
@@ -124,57 +290,98 @@ def get_slice_as_16bit_png(viewer_name, script_path):
     # Get the slice node
     slice_node = slice_logic.GetSliceNode()
     
-    # Get the RAS-to-IJK transformation matrix
-    volume_ras_to_ijk = vtk.vtkMatrix4x4()
-    volume_node.GetRASToIJKMatrix(volume_ras_to_ijk)
-
-    # Get the slice origin in RAS coordinates
-    slice_origin_ras = slice_node.GetSliceToRAS().MultiplyPoint([0, 0, 0, 1])
+    # Map the slice plane into the volume IJK space
+    slice_to_ijk = get_slice_to_ijk(slice_node, volume_node)
+    normal_axis, aligned = find_normal_ijk_axis(slice_to_ijk)
 
-    # Convert slice RAS to IJK
-    slice_origin_ijk = [0, 0, 0, 1]
-    volume_ras_to_ijk.MultiplyPoint(slice_origin_ras, slice_origin_ijk)
-    
-    # Extract the integer slice index
-    slice_index = int(round(slice_origin_ijk[2]))  # Z-index for axial slices
-    
     # Get image data from the scalar volume node
     image_data = volume_node.GetImageData()
     dims = image_data.GetDimensions()
 
-    if slice_index < 0 or slice_index >= dims[2]:
-        print("Error: Slice index out of range.")
-        return
+    if aligned:
+        # Slice origin in IJK gives the index along the normal axis
+        slice_origin_ijk = slice_to_ijk.MultiplyPoint([0, 0, 0, 1])
+        slice_index = int(round(slice_origin_ijk[normal_axis]))
+        if slice_index < 0 or slice_index >= dims[normal_axis]:
+            print("Error: Slice index out of range.")
+            return
 
-    # Convert VTK image data to NumPy array
-    scalars = image_data.GetPointData().GetScalars()
-    volume_array = vtk.util.numpy_support.vtk_to_numpy(scalars)
-    
-    # Reshape to 3D (Z, Y, X)
-    volume_array = volume_array.reshape(dims[2], dims[1], dims[0])
+        # Convert VTK image data to NumPy array
+        scalars = image_data.GetPointData().GetScalars()
+        volume_array = vtk.util.numpy_support.vtk_to_numpy(scalars)
 
-    # Extract the 2D slice
-    slice_array = volume_array[slice_index, :, :]
-    
-    # Normalize to 16-bit
-    slice_array = np.interp(slice_array, (slice_array.min(), slice_array.max()), (0, 65535)).astype(np.uint16)
+        # Reshape to 3D (Z, Y, X)
+        volume_array = volume_array.reshape(dims[2], dims[1], dims[0])
+
+        # Extract the 2D slice directly along the aligned IJK axis, in viewer orientation
+        slice_array = extract_aligned_slice(volume_array, normal_axis, slice_index)
+        slice_array = aligned_slice_to_display(slice_array, normal_axis, slice_to_ijk)
+        valid = None
+    else:
+        # Oblique plane: resample along the slice node's SliceToRAS; there is no voxel index,
+        # so the plane is identified by its offset (mm) along the slice normal
+        slice_index = None
+        slice_offset = slice_node.GetSliceOffset()
+        slice_array, valid = reslice_oblique(viewer_name, volume_node, slice_node, slice_to_ijk)
+        if slice_array is None:
+            print("Error: The slice plane does not intersect the volume.")
+            return
+        slice_array, valid = to_display_orientation(slice_array), to_display_orientation(valid)
     
-    # Convert to PIL Image and save as PNG
-    image = Image.fromarray(slice_array)
+    # Normalize to 16-bit over the voxels inside the volume; background outside it stays 0
+    values = slice_array if valid is None else slice_array[valid]
+    slice_array = np.interp(slice_array, (values.min(), values.max()), (0, 65535)).astype(np.uint16)
+    if valid is not None:
+        slice_array[~valid] = 0
     
-    # Get the study name
-    subject_name = get_subject_name(volume_node)
-    series_number = get_series_number(volume_node)
+    # Get the study name and series (cached per scene)
+    subject_name, series_number = resolve_subject_and_series(volume_node)
     
     # Define the filename with the required suffix
-    output_filename = f"MWALiver_2D_P_{subject_name}_{series_number}s{slice_index}.png"
+    if aligned:
+        # K-normal slices keep the original name; I/J-normal slices of the same volume carry
+        # their axis so they never share a name (or shard key) with a K slice of the same index
+        axis_tag = "" if normal_axis == 2 else f"_{'IJK'[normal_axis]}"
+        output_filename = f"MWALiver_2D_P_{subject_name}_{series_number}{axis_tag}s{slice_index}.png"
+        location = f"Slice {slice_index}"
+    else:
+        output_filename = f"MWALiver_2D_P_{subject_name}_{series_number}_oblique_{slice_offset:.2f}mm.png"
+        location = f"offset {slice_offset:.2f} mm"
 
     # Use the provided script path to determine the output folder
     script_dir = os.path.dirname(script_path)  # Get the folder where the script is stored
+    mode = "IJK-aligned" if aligned else "oblique"
+
+    if shard_size:
+        # DatasetShards.py lives next to this script
+        module_dir = os.path.dirname(os.path.abspath(script_path))
+        if module_dir not in sys.path:
+            sys.path.insert(0, module_dir)
+        from DatasetShards import ShardWriter
+
+        shard_folder = os.path.join(script_dir, "shards")
+        with ShardWriter(shard_folder, shard_size=shard_size) as writer:
+            record = writer.add(os.path.splitext(output_filename)[0], slice_array, {
+                "subject": subject_name,
+                "series": series_number,
+                "slice_index": slice_index,
+                "normal_axis": "IJK"[normal_axis] if aligned else None,
+                "slice_offset_mm": None if aligned else slice_offset,
+                "orientation": slice_node.GetOrientation(),
+                "oblique": not aligned,
+            })
+        print(f"Saved slice from {viewer_name} viewer ({location}, {mode}) to {record['shard']} in {shard_folder}")
+        return
+
+    # Convert to PIL Image and save as PNG; the slice orientation travels in a text chunk
+    # so UnwrapPhase.py can carry it into its shard manifest
+    image = Image.fromarray(slice_array)
     output_path = os.path.join(script_dir, output_filename)
+    png_info = PngImagePlugin.PngInfo()
+    png_info.add_text("orientation", slice_node.GetOrientation())
 
-    image.save(output_path, format="PNG")
-    print(f"Saved slice from {viewer_name} viewer (Slice {slice_index}) as 16-bit PNG: {output_path}")
+    image.save(output_path, format="PNG", pnginfo=png_info)
+    print(f"Saved slice from {viewer_name} viewer ({location}, {mode}) as 16-bit PNG: {output_path}")
 
 # Check if 'viewerName' is defined in the global namespace
 try:
@@ -188,11 +395,17 @@ try:
 except NameError:
     scriptPath = None
 
+# Optional: number of slices per shard (None writes loose PNGs)
+try:
+    shardSize
+except NameError:
+    shardSize = None
+
 if viewerName is None:
     print("Error: Missing required input: 'viewerName'.")
     print("Please define 'viewerName' before executing the script.")
 elif scriptPath is None:
     print("Error: Missing required input: 'scriptPath'. Make sure you pass it in script_globals.")
 else:
-    get_slice_as_16bit_png(viewer_name=viewerName, script_path=scriptPath)
+    get_slice_as_16bit_png(viewer_name=viewerName, script_path=scriptPath, shard_size=shardSize)
     
@@ -1,8 +1,39 @@
+"""
+python3 UnwrapPhase.py --workers 8
+python3 UnwrapPhase.py --input /path/to/phase_2D --output /path/to/unwrapped_phase_2D --workers 8
+
+Runs are resumable: finished images are appended to unwrapped_metadata.journal.jsonl as they
+complete and compacted into unwrapped_metadata.json at the end. Inputs whose output exists and
+whose recorded fingerprint (mtime+size, or SHA-1 with --hash) still matches are skipped.
+
+--mode slice     unwraps each PNG on its own (default).
+--mode volume    stacks the slices of each subject/series/orientation by slice index and runs one
+                 3D unwrap per run of consecutive slice indices (gaps start a new stack; single
+                 slices are unwrapped on their own).
+--mode temporal  stacks the frames of each subject/slice position, unwraps the first frame
+                 spatially and the rest along the frame axis. Frames are the series given with
+                 --series, in that order (e.g. --series 71 73 75): consecutive series numbers are
+                 often separate acquisitions (COR/SAG pairs), so they are never chained implicitly.
+                 Slices of other series are unwrapped on their own.
+Grouped modes still write one unwrapped PNG with its own min/max per input slice.
+
+--output-format npy|both also writes the unwrapped phase itself as float32 unwrapped_<name>.npy
+(no 16-bit quantization; WrapPhaseSingle.py reads it directly). Inputs may be 16-bit PNGs or
+float .npy wrapped phase in [-pi, pi]. With --shard-size, shards hold the 16-bit slices (png) or
+the float32 phase (npy); 'both' cannot be sharded.
+"""
 import os
+import time
+import hashlib
+import argparse
 import numpy as np
 import imageio.v2 as iio
+from PIL import Image
 from skimage.restoration import unwrap_phase
 import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from DatasetShards import ShardWriter, parse_slice_filename, read_manifest, compact_manifest
 
 # === Configuration ===
 #input_folder = '/home/mrthermometry/Datasets/MWALiver/phase_2D'
@@ -10,47 +41,318 @@ import json
 
 input_folder = "/home/mrthermometry/Devel/phase-generative-inpainting/examples/LiverMWA"
 output_folder = "/home/mrthermometry/Devel/phase-generative-inpainting/examples/LiverMWA"
-metadata_path = os.path.join(output_folder, 'unwrapped_metadata.json')
 
-os.makedirs(output_folder, exist_ok=True)
+# Optional sharded output: N unwrapped slices per tar shard plus manifest.jsonl
+# (None keeps the loose unwrapped_*.png files)
+shard_size = None
+
+OUTPUT_PREFIX = "unwrapped_"
+INPUT_EXTENSIONS = (".png", ".npy")
+
+
+def input_fingerprint(input_path, use_hash=False):
+    """Identify the input content: SHA-1 of the file, or its mtime and size."""
+    if use_hash:
+        h = hashlib.sha1()
+        with open(input_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return {"source_sha1": h.hexdigest()}
+    st = os.stat(input_path)
+    return {"source_mtime_ns": st.st_mtime_ns, "source_size": st.st_size}
+
+
+def load_metadata(metadata_path, journal_path):
+    """Load the compacted metadata JSON and replay any journal left by an interrupted run."""
+    metadata = {}
+    if os.path.isfile(metadata_path):
+        with open(metadata_path, "r") as f:
+            metadata = json.load(f)
+    if os.path.isfile(journal_path):
+        with open(journal_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # truncated last line from a crash
+                metadata[entry.pop("file")] = entry
+    return metadata
+
+
+def compact_metadata(metadata, metadata_path, journal_path):
+    """Write the merged metadata JSON atomically, then drop the journal."""
+    tmp_path = metadata_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(metadata, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, metadata_path)
+    if os.path.isfile(journal_path):
+        os.remove(journal_path)
+
 
-# === Metadata dictionary ===
-metadata = {}
+def output_names(filename, output_format="png"):
+    """Output filenames written for one input in the given format ('png', 'npy' or 'both')."""
+    stem = os.path.splitext(filename)[0]
+    extensions = {"png": (".png",), "npy": (".npy",), "both": (".png", ".npy")}[output_format]
+    return [f"{OUTPUT_PREFIX}{stem}{ext}" for ext in extensions]
 
-# === Processing Loop ===
-for filename in os.listdir(input_folder):
-    if filename.lower().endswith(".png"):
-        input_path = os.path.join(input_folder, filename)
-        print(f"Processing: {filename}")
 
-        # Load 16-bit image
-        image = iio.imread(input_path).astype(np.float64)
+def read_orientation(input_path):
+    """Slice orientation stored by SaveSliceAsPng.py in the PNG text chunk, or None."""
+    if not input_path.lower().endswith(".png"):
+        return None
+    with Image.open(input_path) as image:
+        return getattr(image, "text", {}).get("orientation")
 
-        # Normalize to [-pi, pi]
-        image_norm = (image / 65535.0) * 2 * np.pi - np.pi
 
-        # Unwrap the phase
-        unwrapped = unwrap_phase(image_norm)
+def load_wrapped(input_path):
+    """Load a phase image normalized to [-pi, pi] (16-bit PNG, or float .npy already in radians)."""
+    if input_path.lower().endswith(".npy"):
+        return np.load(input_path).astype(np.float64)
 
-        # Save unwrapped min/max for this image
-        unwrapped_min = float(np.min(unwrapped))
-        unwrapped_max = float(np.max(unwrapped))
-        metadata[filename] = {
-            "unwrapped_min": unwrapped_min,
-            "unwrapped_max": unwrapped_max
-        }
+    # Load 16-bit image
+    image = iio.imread(input_path).astype(np.float64)
 
-        # Normalize unwrapped for saving
+    # Normalize to [-pi, pi]
+    return (image / 65535.0) * 2 * np.pi - np.pi
+
+
+def save_unwrapped(filename, unwrapped, output_folder, return_array=False, output_format="png"):
+    """
+    Rescale one unwrapped slice to 16 bits and write unwrapped_<name>.png to output_folder,
+    and/or the float32 unwrapped phase as unwrapped_<name>.npy (see output_format).
+
+    Returns:
+        (str, dict, ndarray or None): The filename, its min/max metadata, and the array to shard
+        when return_array is set (16-bit, or float32 for output_format 'npy'; sharded output is
+        written by the caller).
+    """
+    # Save unwrapped min/max for this image
+    unwrapped_min = float(np.min(unwrapped))
+    unwrapped_max = float(np.max(unwrapped))
+    meta = {
+        "unwrapped_min": unwrapped_min,
+        "unwrapped_max": unwrapped_max
+    }
+
+    if return_array and output_format == "npy":
+        return filename, meta, np.asarray(unwrapped, dtype=np.float32)
+
+    # Normalize unwrapped for saving (skipped for float-only output)
+    unwrapped_16bit = None
+    if return_array or output_format != "npy":
         unwrapped_scaled = (unwrapped - unwrapped_min) / (unwrapped_max - unwrapped_min)
         unwrapped_16bit = (unwrapped_scaled * 65535).astype(np.uint16)
 
-        # Save image
-        output_path = os.path.join(output_folder, f"unwrapped_{filename}")
-        iio.imwrite(output_path, unwrapped_16bit)
+    if return_array:
+        return filename, meta, unwrapped_16bit
+
+    # Save image(s)
+    for name in output_names(filename, output_format):
+        output_path = os.path.join(output_folder, name)
+        if name.endswith(".npy"):
+            np.save(output_path, np.asarray(unwrapped, dtype=np.float32))
+        else:
+            iio.imwrite(output_path, unwrapped_16bit)
+    return filename, meta, None
+
+
+def unwrap_group(filenames, input_folder, output_folder, mode="slice", return_array=False, output_format="png"):
+    """
+    Unwrap a group of slices with one solver call and save each slice.
+
+    Parameters:
+        filenames (list): Ordered slice filenames (by slice index for 'volume', by series for 'temporal').
+        mode (str): 'slice', 'volume' or 'temporal' (see module docstring).
+
+    Returns:
+        list: One save_unwrapped result per filename, in the same order.
+    """
+    stack = [load_wrapped(os.path.join(input_folder, f)) for f in filenames]
+
+    if len(stack) > 1 and len({im.shape for im in stack}) > 1:
+        print(f"[WARN] Mixed image sizes in group starting at {filenames[0]}; unwrapping slice by slice.")
+        mode = "slice"
+
+    if mode == "slice" or len(stack) == 1:
+        unwrapped = [unwrap_phase(im) for im in stack]
+    elif mode == "volume":
+        unwrapped = unwrap_phase(np.stack(stack))
+    elif mode == "temporal":
+        # Spatially unwrap the first frame, then carry it through time pixel by pixel
+        frames = np.stack(stack)
+        frames[0] = unwrap_phase(frames[0])
+        unwrapped = np.unwrap(frames, axis=0)
+    else:
+        raise ValueError(f"Unknown unwrap mode: {mode}")
+
+    return [save_unwrapped(f, u, output_folder, return_array, output_format) for f, u in zip(filenames, unwrapped)]
+
+
+def consecutive_runs(members):
+    """Split (slice_index, filename) pairs sorted by index into runs of consecutive indices."""
+    runs = []
+    for index, filename in members:
+        if runs and index == runs[-1][-1][0] + 1:
+            runs[-1].append((index, filename))
+        else:
+            runs.append([(index, filename)])
+    return runs
+
+
+def group_files(filenames, mode="slice", series=None, orientations=None):
+    """
+    Group slice filenames for a combined unwrap.
+
+    'volume' groups by (prefix, subject, series, normal axis, orientation) ordered by slice
+    index and split into runs of consecutive indices, so only neighbouring planes are unwrapped
+    together; 'temporal' groups by (prefix, subject, slice index, normal axis, orientation) the
+    frames whose series is listed in 'series', ordered as in that list. orientations maps
+    filenames to the slice orientation stored by SaveSliceAsPng.py (read_orientation), since
+    names only carry the normal axis.
+    Names that do not follow the SaveSliceAsPng convention, and slices of unlisted series in
+    'temporal' mode, stay in groups of one (unwrapped slice by slice).
+    """
+    if mode == "slice":
+        return [[f] for f in filenames]
+    if mode == "temporal" and not series:
+        raise ValueError("Temporal mode needs the ordered list of frame series (--series).")
+    frame_order = {int(s): i for i, s in enumerate(series or [])}
+    orientations = orientations or {}
+
+    groups = {}
+    for filename in filenames:
+        info = parse_slice_filename(filename)
+        if info["slice_index"] is None or info["series"] is None or \
+                (mode == "temporal" and info["series"] not in frame_order):
+            groups[("", filename)] = [(0, filename)]
+            continue
+        orientation = orientations.get(filename)
+        if mode == "volume":
+            key = (info["prefix"], info["subject"], info["series"], info["normal_axis"], orientation)
+            order = info["slice_index"]
+        else:
+            key = (info["prefix"], info["subject"], info["slice_index"], info["normal_axis"], orientation)
+            order = frame_order[info["series"]]
+        groups.setdefault(key, []).append((order, filename))
+
+    result = []
+    for key, members in sorted(groups.items(), key=lambda kv: str(kv[0])):
+        members.sort()
+        runs = consecutive_runs(members) if mode == "volume" else [members]
+        result.extend([f for _, f in run] for run in runs)
+    return result
+
+
+def main(input_folder, output_folder, workers=1, shard_size=None, use_hash=False, mode="slice",
+         output_format="png", series=None):
+    if shard_size and output_format == "both":
+        raise ValueError("Sharded output stores one array per slice: use --output-format png or npy with --shard-size.")
+    metadata_path = os.path.join(output_folder, 'unwrapped_metadata.json')
+    journal_path = os.path.join(output_folder, 'unwrapped_metadata.journal.jsonl')
+    shard_folder = os.path.join(output_folder, 'unwrapped_shards')
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Never re-read our own outputs when input and output folders are the same
+    candidates = sorted(f for f in os.listdir(input_folder)
+                        if f.lower().endswith(INPUT_EXTENSIONS) and not f.startswith(OUTPUT_PREFIX))
+
+    # === Metadata dictionary (previous runs + journal) ===
+    metadata = load_metadata(metadata_path, journal_path)
+    if shard_size:
+        existing_outputs = {r.get("source") for r in read_manifest(shard_folder)}
+        output_exists = lambda filename: filename in existing_outputs
+    else:
+        output_exists = lambda filename: all(os.path.isfile(os.path.join(output_folder, name))
+                                             for name in output_names(filename, output_format))
+
+    stale = set()
+    fingerprints = {}
+    for filename in candidates:
+        fingerprints[filename] = input_fingerprint(os.path.join(input_folder, filename), use_hash)
+        entry = metadata.get(filename)
+        up_to_date = entry is not None and all(entry.get(k) == v for k, v in fingerprints[filename].items())
+        if not (up_to_date and output_exists(filename)):
+            stale.add(filename)
+
+    # Orientation is part of the group key (AX/COR/SAG exports of one series can share a shape)
+    orientations = {} if mode == "slice" else \
+        {f: read_orientation(os.path.join(input_folder, f)) for f in candidates}
+
+    # A group is redone as a whole if any of its slices is stale, to keep its offsets consistent
+    groups = [g for g in group_files(candidates, mode, series, orientations) if stale.intersection(g)]
+    total = sum(len(g) for g in groups)
+    print(f"Unwrapping {total} images in {len(groups)} group(s) with {workers} worker(s), mode '{mode}' "
+          f"({len(candidates) - total} up to date, skipped).")
+
+    writer = ShardWriter(shard_folder, shard_size=shard_size) if shard_size else None
+    journal = open(journal_path, "a")
+    job = partial(unwrap_group, input_folder=input_folder, output_folder=output_folder,
+                  mode=mode, return_array=writer is not None, output_format=output_format)
+
+    def collect(filename, meta, unwrapped_16bit):
+        nonlocal done
+        done += 1
+        meta.update(fingerprints[filename])
+        metadata[filename] = meta
+        if writer:
+            # Append to the current shard with its manifest record
+            record = parse_slice_filename(filename)
+            record.update(meta, source=filename,
+                          orientation=read_orientation(os.path.join(input_folder, filename)))
+            writer.add(f"{OUTPUT_PREFIX}{os.path.splitext(filename)[0]}", unwrapped_16bit, record)
+        # Journal after the output is written so a crash never records missing outputs
+        journal.write(json.dumps(dict(meta, file=filename)) + "\n")
+        journal.flush()
+        rate = done / max(time.perf_counter() - t0, 1e-9)
+        print(f"[{done}/{total}] {filename}  ({rate:.2f} images/s)")
+
+    # === Processing Loop ===
+    done = 0
+    t0 = time.perf_counter()
+    try:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(job, group) for group in groups]
+                for future in as_completed(futures):
+                    for result in future.result():
+                        collect(*result)
+        else:
+            for group in groups:
+                for result in job(group):
+                    collect(*result)
+    finally:
+        journal.close()
+        if writer:
+            writer.close()
+            # Drop records superseded by a redo of a changed input (or a crash before journaling)
+            dropped = compact_manifest(shard_folder)
+            if dropped:
+                print(f"Dropped {dropped} superseded manifest record(s).")
+            print(f"Sharded slices and manifest written to: {shard_folder}")
+
+    elapsed = time.perf_counter() - t0
+    print(f"Unwrapped {total} images in {elapsed:.1f} s ({total / max(elapsed, 1e-9):.2f} images/s).")
+
+    # === Compact journal into metadata JSON (sorted keys, independent of completion order) ===
+    compact_metadata(metadata, metadata_path, journal_path)
+
+    print(f"All images processed and saved with metadata at: {metadata_path}")
 
-# === Save metadata JSON ===
-with open(metadata_path, "w") as f:
-    json.dump(metadata, f, indent=2)
 
-print(f"All images processed and saved with metadata at: {metadata_path}")
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Unwrap 16-bit phase PNGs and store per-image min/max metadata.")
+    ap.add_argument("--input", default=input_folder, help="Folder with wrapped phase PNGs")
+    ap.add_argument("--output", default=output_folder, help="Folder for unwrapped_*.png and unwrapped_metadata.json")
+    ap.add_argument("--workers", type=int, default=1, help="Number of worker processes (default 1 = serial)")
+    ap.add_argument("--shard-size", type=int, default=shard_size, help="Write N slices per tar shard instead of loose PNGs")
+    ap.add_argument("--hash", action="store_true", help="Detect changed inputs by SHA-1 instead of mtime and size")
+    ap.add_argument("--mode", choices=["slice", "volume", "temporal"], default="slice",
+                    help="Unwrap each slice, each subject/series stack in 3D, or each slice position over time")
+    ap.add_argument("--series", type=int, nargs="*", default=None,
+                    help="Temporal mode: series numbers of the frames, in time order")
+    ap.add_argument("--output-format", choices=["png", "npy", "both"], default="png",
+                    help="16-bit PNG, float32 .npy sidecar of the unwrapped phase, or both")
+    args = ap.parse_args()
 
+    main(args.input, args.output, workers=max(1, args.workers), shard_size=args.shard_size,
+         use_hash=args.hash, mode=args.mode, output_format=args.output_format, series=args.series)
@@ -1,62 +1,335 @@
+"""
+python3 WrapPhaseSingle.py
+python3 WrapPhaseSingle.py --input-folder /path/to/inpainted --output-folder /path/to/wrapped --workers 8
+python3 WrapPhaseSingle.py --inputs a.png b.png --metadata /path/to/unwrapped_metadata.json
+python3 WrapPhaseSingle.py --check-round-trip /path/to/phase_2D --metadata /path/to/unwrapped_phase_2D/unwrapped_metadata.json
+
+Without arguments, wraps the single configured image below. In batch mode the metadata is loaded
+once and every image is written as <name>_phase.png; images without a metadata entry are skipped.
+
+UnwrapPhase.py keys its metadata by the wrapped input name (X.png) and writes unwrapped_X.png,
+so the unwrapped_ prefix is stripped to find an image's entry (inpainted images keep either
+name). Raw wrapped inputs found next to the metadata JSON (UnwrapPhase.py run with the same
+input and output folder) are not unwrapped outputs and are skipped.
+--check-round-trip re-wraps the unwrapped_X outputs and compares them with the raw inputs X.
+
+Float32 unwrapped phase (unwrapped_<name>.npy from UnwrapPhase.py --output-format npy) is read
+memory-mapped and wrapped directly, without metadata or 16-bit quantization. When a .npy and a PNG
+share a name, only the .npy is wrapped. With
+--output-format npy the wrapped phase is written as float32 .npy in [-pi, pi] instead of a PNG.
+"""
 import os
+import time
+import argparse
 import numpy as np
 import imageio.v3 as iio
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 # === Input and Output ===
 input_path = "/home/mrthermometry/Devel/phase-generative-inpainting/examples/output_unwrap.png"
 output_path = "/home/mrthermometry/Devel/phase-generative-inpainting/examples/output_unwrap_phase.png"
 metadata_path = "/home/mrthermometry/Devel/phase-generative-inpainting/examples/unwrapped_metadata.json"
 
-# Ensure output directory exists
-os.makedirs(os.path.dirname(output_path), exist_ok=True)
+OUTPUT_SUFFIX = "_phase"
+# Prefix of UnwrapPhase.py outputs (its OUTPUT_PREFIX)
+UNWRAPPED_PREFIX = "unwrapped_"
+
+
+def load_metadata(metadata_path):
+    with open(metadata_path, 'r') as f:
+        return json.load(f)
+
+
+def metadata_key(path):
+    """Metadata entry of an unwrapped or inpainted image: its name without the unwrapped_ prefix."""
+    filename = os.path.basename(path)
+    return filename[len(UNWRAPPED_PREFIX):] if filename.startswith(UNWRAPPED_PREFIX) else filename
+
+
+def is_raw_input(path, metadata_path):
+    """
+    True for a wrapped UnwrapPhase.py input sitting next to the metadata JSON: that folder only
+    holds unwrapped_ outputs unless UnwrapPhase.py wrote into its own input folder.
+    """
+    return (not os.path.basename(path).startswith(UNWRAPPED_PREFIX)
+            and os.path.dirname(os.path.abspath(path)) == os.path.dirname(os.path.abspath(metadata_path)))
+
+
+def load_16bit(path):
+    """Load a 16-bit image; RGB images are reduced to their first channel."""
+    image_16bit = iio.imread(path)
+    # If image is RGB, convert to grayscale
+    if image_16bit.ndim == 3 and image_16bit.shape[2] == 3:
+        image_16bit = image_16bit[:, :, 0]
+    return image_16bit
+
+
+def wrap_to_16bit(image_16bit, unwrapped_min, unwrapped_max):
+    """
+    Rescale a 16-bit unwrapped image to its original range, wrap it to [-pi, pi]
+    and return it as 16 bits. Inverse of the scaling in UnwrapPhase.py.
+
+    Works in a single float64 buffer with in-place ufuncs, applying the same operations in
+    the same order as reference_wrap_to_16bit, so the output is bit-identical to it:
+        unwrapped = image / 65535 * (max - min) + min
+        wrapped   = (unwrapped + pi) % 2pi - pi
+        output    = (wrapped + pi) / 2pi * 65535   (truncated to uint16)
+    """
+    x = np.asarray(image_16bit).astype(np.float64)
+    np.divide(x, 65535.0, out=x)
+    np.multiply(x, unwrapped_max - unwrapped_min, out=x)
+    np.add(x, unwrapped_min, out=x)
+    np.add(x, np.pi, out=x)
+    np.mod(x, 2 * np.pi, out=x)
+    np.subtract(x, np.pi, out=x)
+    np.add(x, np.pi, out=x)
+    np.divide(x, 2 * np.pi, out=x)
+    np.multiply(x, 65535, out=x)
+    return np.squeeze(x.astype(np.uint16))
+
+
+def reference_wrap_to_16bit(image_16bit, unwrapped_min, unwrapped_max):
+    """Original single-image arithmetic of this script, kept as the parity reference."""
+    image_scaled = np.asarray(image_16bit).astype(np.float64) / 65535.0
+    unwrapped = image_scaled * (unwrapped_max - unwrapped_min) + unwrapped_min
+    wrapped = (unwrapped + np.pi) % (2 * np.pi) - np.pi
+    wrapped_scaled = (wrapped + np.pi) / (2 * np.pi)
+    return np.squeeze((wrapped_scaled * 65535).astype(np.uint16))
+
+
+def check_parity(metadata, input_paths=()):
+    """
+    Compare wrap_to_16bit with reference_wrap_to_16bit on every 16-bit value for each metadata
+    range (or a default range without metadata), and on the given PNG inputs.
+
+    Returns:
+        int: Number of mismatching pixels (0 means bit-identical).
+    """
+    ramp = np.arange(65536, dtype=np.uint16).reshape(256, 256)
+    ranges = {(m["unwrapped_min"], m["unwrapped_max"]) for m in metadata.values()} or {(-3 * np.pi, 5 * np.pi)}
+    mismatches = 0
+    for lo, hi in sorted(ranges):
+        mismatches += int(np.count_nonzero(wrap_to_16bit(ramp, lo, hi) != reference_wrap_to_16bit(ramp, lo, hi)))
+    for path in input_paths:
+        key = metadata_key(path)
+        if path.lower().endswith(".npy") or key not in metadata:
+            continue
+        image = load_16bit(path)
+        lo, hi = metadata[key]["unwrapped_min"], metadata[key]["unwrapped_max"]
+        mismatches += int(np.count_nonzero(wrap_to_16bit(image, lo, hi) != reference_wrap_to_16bit(image, lo, hi)))
+    print(f"[PARITY] {len(ranges)} range(s) x 65536 values, {len(input_paths)} input(s): {mismatches} mismatching pixels.")
+    return mismatches
+
+
+def check_round_trip(raw_folder, metadata_path):
+    """
+    Re-wrap the UnwrapPhase.py outputs next to metadata_path (unwrapped_X.npy, else unwrapped_X.png)
+    and compare them with the raw wrapped inputs X in raw_folder.
+
+    Differences are measured on the phase circle in 16-bit codes (0 and 65535 are both +-pi). A
+    pixel passes within the quantization of the chain: one code for each truncation plus the
+    16-bit step of the unwrapped range ((max - min) / 2pi codes) for PNG outputs.
+
+    Returns:
+        int: Number of pixels outside the tolerance (0 means the round trip reproduces the inputs).
+    """
+    metadata = load_metadata(metadata_path)
+    unwrapped_folder = os.path.dirname(os.path.abspath(metadata_path))
+    checked = mismatches = 0
+    worst = 0
+    for key in sorted(metadata):
+        raw_path = os.path.join(raw_folder, key)
+        stem = os.path.splitext(key)[0]
+        npy_path = os.path.join(unwrapped_folder, f"{UNWRAPPED_PREFIX}{stem}.npy")
+        png_path = os.path.join(unwrapped_folder, f"{UNWRAPPED_PREFIX}{key}")
+        if not raw_path.lower().endswith(".png") or not os.path.isfile(raw_path):
+            continue
+        lo, hi = metadata[key]["unwrapped_min"], metadata[key]["unwrapped_max"]
+        if os.path.isfile(npy_path):
+            rewrapped = wrap_float(np.load(npy_path, mmap_mode="r"))
+            tolerance = 2
+        elif os.path.isfile(png_path):
+            rewrapped = wrap_to_16bit(load_16bit(png_path), lo, hi)
+            tolerance = 2 + int(np.ceil((hi - lo) / (2 * np.pi)))
+        else:
+            continue
+        diff = np.abs(rewrapped.astype(np.int64) - load_16bit(raw_path).astype(np.int64))
+        diff = np.minimum(diff, 65535 - diff)
+        bad = int(np.count_nonzero(diff > tolerance))
+        if bad:
+            print(f"[WARN] {key}: {bad} pixel(s) differ by more than {tolerance} codes (max {int(diff.max())}).")
+        mismatches += bad
+        worst = max(worst, int(diff.max()))
+        checked += 1
+    print(f"[ROUND-TRIP] {checked} image(s) re-wrapped, max difference {worst} codes: {mismatches} pixels out of tolerance.")
+    return mismatches
+
+
+def wrap_float(unwrapped, as_16bit=True):
+    """
+    Wrap float unwrapped phase (radians) to [-pi, pi] in one float64 buffer.
+
+    Returns:
+        ndarray: 16-bit image scaled like wrap_to_16bit, or float32 radians if as_16bit is False.
+    """
+    x = np.asarray(unwrapped).astype(np.float64)
+    np.add(x, np.pi, out=x)
+    np.mod(x, 2 * np.pi, out=x)
+    np.subtract(x, np.pi, out=x)
+    if as_16bit:
+        np.add(x, np.pi, out=x)
+        np.divide(x, 2 * np.pi, out=x)
+        np.multiply(x, 65535, out=x)
+        return np.squeeze(x.astype(np.uint16))
+    return np.squeeze(x.astype(np.float32))
+
+
+def wrap_file(input_path, output_path, metadata, output_format="png"):
+    """
+    Wrap one image; .npy inputs are float phase, PNG inputs use their metadata entry.
+
+    Returns:
+        bool: False if a PNG input has no metadata entry.
+    """
+    as_16bit = output_format == "png"
+    if input_path.lower().endswith(".npy"):
+        wrapped = wrap_float(np.load(input_path, mmap_mode="r"), as_16bit=as_16bit)
+    else:
+        # UnwrapPhase.py input name (no path, no unwrapped_ prefix) to match key in metadata
+        key = metadata_key(input_path)
+        if key not in metadata:
+            return False
+        wrapped = wrap_to_16bit(load_16bit(input_path),
+                                metadata[key]["unwrapped_min"], metadata[key]["unwrapped_max"])
+        if not as_16bit:
+            # Back to radians in [-pi, pi]
+            wrapped = (wrapped.astype(np.float64) / 65535.0 * (2 * np.pi) - np.pi).astype(np.float32)
+
+    # Ensure 2D before saving
+    if wrapped.ndim != 2:
+        raise ValueError(f"Expected 2D grayscale image, got shape: {wrapped.shape}")
+    if as_16bit:
+        iio.imwrite(output_path, wrapped)
+    else:
+        np.save(output_path, wrapped)
+    return True
+
+
+def dedupe_by_stem(input_paths):
+    """
+    Keep one input per file stem, since both map to the same <stem>_phase output.
+    The float .npy is preferred over the PNG (UnwrapPhase.py --output-format both writes both).
+    """
+    chosen = {}
+    for path in input_paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if stem not in chosen or (path.lower().endswith(".npy") and not chosen[stem].lower().endswith(".npy")):
+            chosen[stem] = path
+    kept = set(chosen.values())
+    for path in input_paths:
+        if path not in kept:
+            print(f"[INFO] {os.path.basename(path)} skipped, using {os.path.basename(chosen[os.path.splitext(os.path.basename(path))[0]])}.")
+    return [p for p in input_paths if p in kept]
+
+
+def wrap_batch(input_paths, output_folder, metadata_path, workers=4, output_format="png"):
+    """Wrap many images with one metadata load, decoding/encoding PNGs in a thread pool."""
+    os.makedirs(output_folder, exist_ok=True)
+    raw = [p for p in input_paths if is_raw_input(p, metadata_path)]
+    if raw:
+        print(f"[INFO] {len(raw)} raw wrapped input(s) next to the metadata JSON skipped (only unwrapped_* outputs are wrapped).")
+        input_paths = [p for p in input_paths if p not in raw]
+    input_paths = dedupe_by_stem(input_paths)
+    # Metadata is only needed for PNG inputs
+    needs_metadata = any(not p.lower().endswith(".npy") for p in input_paths)
+    metadata = load_metadata(metadata_path) if needs_metadata else {}
+
+    def job(path):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        output_path = os.path.join(output_folder, f"{stem}{OUTPUT_SUFFIX}.{output_format}")
+        return path, wrap_file(path, output_path, metadata, output_format)
+
+    t0 = time.perf_counter()
+    written = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, ok in pool.map(job, input_paths):
+            if ok:
+                written += 1
+            else:
+                print(f"[WARN] {os.path.basename(path)}: no '{metadata_key(path)}' entry in metadata JSON, skipped.")
+    elapsed = time.perf_counter() - t0
+    print(f"Wrapped {written}/{len(input_paths)} images in {elapsed:.1f} s "
+          f"({written / max(elapsed, 1e-9):.1f} images/s) into: {output_folder}")
+
 
-# === Load metadata JSON ===
-with open(metadata_path, 'r') as f:
-    metadata = json.load(f)
+def main_single(input_path, output_path, metadata_path):
+    # Ensure output directory exists
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-# Get filename only (no path) to match key in metadata
-filename = os.path.basename(input_path)
-if filename not in metadata:
-    raise KeyError(f"{filename} not found in metadata JSON")
+    # === Load metadata JSON ===
+    metadata = load_metadata(metadata_path)
 
-unwrapped_min = metadata[filename]["unwrapped_min"]
-unwrapped_max = metadata[filename]["unwrapped_max"]
-print(f"[INFO] Loaded metadata: min={unwrapped_min:.4f}, max={unwrapped_max:.4f}")
+    filename = metadata_key(input_path)
+    if filename not in metadata:
+        raise KeyError(f"{filename} not found in metadata JSON")
 
-# === Load the image ===
-image_16bit = iio.imread(input_path).astype(np.float64)
+    unwrapped_min = metadata[filename]["unwrapped_min"]
+    unwrapped_max = metadata[filename]["unwrapped_max"]
+    print(f"[INFO] Loaded metadata: min={unwrapped_min:.4f}, max={unwrapped_max:.4f}")
 
-# If image is RGB, convert to grayscale
-if image_16bit.ndim == 3 and image_16bit.shape[2] == 3:
-    print("Converting RGB to grayscale...")
-    image_16bit = image_16bit[:, :, 0]
+    # === Load the image ===
+    image_16bit = load_16bit(input_path)
+    print(f"[INFO] Loaded image shape: {image_16bit.shape}")
+    print(f"[INFO] Raw 16-bit range: min={image_16bit.min()}, max={image_16bit.max()}")
 
-print(f"[INFO] Loaded image shape: {image_16bit.shape}")
-print(f"[INFO] Raw 16-bit range: min={image_16bit.min()}, max={image_16bit.max()}")
+    # === Rescale and wrap phase to [-π, π]
+    wrapped_16bit = wrap_to_16bit(image_16bit, unwrapped_min, unwrapped_max)
+    print(f"[INFO] Wrapped 16-bit range: min={wrapped_16bit.min()}, max={wrapped_16bit.max()}")
 
-# Normalize to [0, 1]
-image_scaled = image_16bit / 65535.0
-print(f"[INFO] Image scaled to [0,1] range: min={image_scaled.min():.4f}, max={image_scaled.max():.4f}")
+    # Ensure 2D before saving
+    if wrapped_16bit.ndim != 2:
+        raise ValueError(f"Expected 2D grayscale image, got shape: {wrapped_16bit.shape}")
 
-# Rescale to original unwrapped range
-unwrapped = image_scaled * (unwrapped_max - unwrapped_min) + unwrapped_min
-print(f"[INFO] Unwrapped range: min={unwrapped.min():.4f}, max={unwrapped.max():.4f}")
+    # === Save result
+    iio.imwrite(output_path, wrapped_16bit)
+    print(f"Wrapped image saved to: {output_path}")
 
-# === Wrap phase to [-π, π]
-wrapped = (unwrapped + np.pi) % (2 * np.pi) - np.pi
-print(f"[INFO] Wrapped range: min={wrapped.min():.4f}, max={wrapped.max():.4f}")
 
-# Normalize to [0,1] and convert to 16-bit
-wrapped_scaled = (wrapped + np.pi) / (2 * np.pi)
-wrapped_16bit = (wrapped_scaled * 65535).astype(np.uint16)
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Re-wrap 16-bit unwrapped phase images using unwrapped_metadata.json.")
+    ap.add_argument("--input-folder", default=None, help="Wrap every PNG in this folder")
+    ap.add_argument("--inputs", nargs="*", default=None, help="Explicit list of PNGs to wrap")
+    ap.add_argument("--output-folder", default=None, help="Output folder for batch mode (default: the input folder, or that of the first input)")
+    ap.add_argument("--metadata", default=metadata_path, help="Path to unwrapped_metadata.json")
+    ap.add_argument("--workers", type=int, default=4, help="Threads for PNG decode/encode in batch mode")
+    ap.add_argument("--output-format", choices=["png", "npy"], default="png",
+                    help="16-bit PNG or float32 .npy wrapped phase (batch mode)")
+    ap.add_argument("--check-round-trip", metavar="RAW_FOLDER", default=None,
+                    help="Verify that re-wrapping the UnwrapPhase.py outputs next to --metadata reproduces "
+                         "the raw wrapped inputs in RAW_FOLDER, then exit")
+    ap.add_argument("--check-parity", action="store_true",
+                    help="Verify the batch arithmetic is bit-identical to the original single-image wrap, then exit")
+    args = ap.parse_args()
 
-# Ensure 2D before saving
-wrapped_16bit = np.squeeze(wrapped_16bit)
-if wrapped_16bit.ndim != 2:
-    raise ValueError(f"Expected 2D grayscale image, got shape: {wrapped_16bit.shape}")
+    if args.check_round_trip:
+        raise SystemExit(1 if check_round_trip(args.check_round_trip, args.metadata) else 0)
 
-# === Save result
-iio.imwrite(output_path, wrapped_16bit)
-print(f"Wrapped image saved to: {output_path}")
+    if args.check_parity:
+        parity_inputs = list(args.inputs or [])
+        if args.input_folder:
+            parity_inputs += sorted(os.path.join(args.input_folder, f) for f in os.listdir(args.input_folder)
+                                    if f.lower().endswith(".png"))
+        parity_metadata = load_metadata(args.metadata) if os.path.isfile(args.metadata) else {}
+        raise SystemExit(1 if check_parity(parity_metadata, parity_inputs) else 0)
 
+    if args.input_folder or args.inputs:
+        paths = list(args.inputs or [])
+        if args.input_folder:
+            paths += sorted(os.path.join(args.input_folder, f) for f in os.listdir(args.input_folder)
+                            if f.lower().endswith((".png", ".npy"))
+                            and not os.path.splitext(f)[0].endswith(OUTPUT_SUFFIX))
+        out_folder = args.output_folder or args.input_folder or os.path.dirname(os.path.abspath(paths[0]))
+        wrap_batch(paths, out_folder, args.metadata, workers=max(1, args.workers), output_format=args.output_format)
+    else:
+        main_single(input_path, output_path, args.metadata)
@@ -6,6 +6,16 @@ filePath = "/Users/pl771/Devel/AI_Tracking_Experiment/FitTarget2MaxDepth.py"
 
 # Define the variable to pass
 script_globals = {'markupName': 'FiducialPoints', 'pointPrefix': 'C', 'targetName': 'target', 'x': -26.0, 'y': -17.0}
+# Batch: targets for many template holes, for one or several rings, in one markups node
+script_globals = {'markupName': 'FiducialPoints', 'pointPrefixes': ['C', 'R'], 'targetName': 'targets',
+                  'xy': [(-26.0, -17.0), (-20.0, -17.0), (-14.0, -17.0)]}
+# Optional: robust plane fit ('ransac' or 'irls'); point sets with too many outliers are rejected
+script_globals = {'markupName': 'FiducialPoints', 'pointPrefix': 'C', 'targetName': 'target', 'x': -26.0, 'y': -17.0,
+                  'robustFit': 'ransac'}
+# Live: the target follows edits of the 'C-i' points until stopped
+script_globals = {'markupName': 'FiducialPoints', 'pointPrefix': 'C', 'targetName': 'target', 'x': -26.0, 'y': -17.0,
+                  'live': True}
+script_globals['stop_live_target']()
 
 # Execute the script with the provided globals
 exec(open(filePath, encoding='utf-8').read(), script_globals)
@@ -14,13 +24,30 @@ exec(open(filePath, encoding='utf-8').read(), script_globals)
 
 import numpy as np
 import sys
-import slicer
+import types
+import slicer, vtk
 import re
 
+# Qt from the script globals when Slicer passes it, else Slicer's PythonQt module
+try:
+    qt
+except NameError:
+    import qt
+
 RING_OFFSET = 5  #5mm offset from fiducial to max insertion depth
 
-def create_or_update_markup(targetName, x, y, z):
+# Robust plane fit: inlier distance and acceptance limits for the ring fiducials
+INLIER_THRESHOLD_MM = 1.0
+# More inliers than the 3-point minimal sample, which fits exactly (RMS 0) and cannot be checked
+MIN_INLIERS = 4
+MIN_INLIER_FRACTION = 0.75
+MAX_RMS_MM = 0.5
 
+def create_or_update_markups(targetName, points, labels):
+    """
+    Replace the control points of the fiducial node 'targetName' (created if missing)
+    with 'points' (Nx3) and their labels, in one bulk update.
+    """
     # Check if a markup node with the given name exists
     markupNode = None
     nodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLMarkupsFiducialNode')
@@ -39,12 +66,19 @@ def create_or_update_markup(targetName, x, y, z):
         # Use the existing markup node
         pass
 
-    # Remove all current control points
-    markupNode.RemoveAllControlPoints()
+    # Set all points at once, then their labels, inside one modify block
+    wasModifying = markupNode.StartModify()
+    try:
+        slicer.util.updateMarkupsControlPointsFromArray(markupNode, np.asarray(points, dtype=float).reshape(-1, 3))
+        for idx, label in enumerate(labels):
+            markupNode.SetNthControlPointLabel(idx, label)
+    finally:
+        markupNode.EndModify(wasModifying)
+    return markupNode
 
-    # Add a single control point with label 'target' at coordinates (x, y, z)
-    pointIndex = markupNode.AddControlPoint([x, y, z])
-    markupNode.SetNthControlPointLabel(pointIndex, 'target')
+def create_or_update_markup(targetName, x, y, z):
+    # Single control point with label 'target' at coordinates (x, y, z)
+    return create_or_update_markups(targetName, [[x, y, z]], ['target'])
 
 def offset_parallel_plane(A, B, C, D, offset_distance, direction='positive'):
     """
@@ -114,7 +148,303 @@ def fit_plane_to_points(points):
     return A, B, C, D
 
 
-def main(markupName, pointPrefix, targetName, x, y):
+def _svd_plane(points, weights=None):
+    """Weighted total least-squares plane (unit normal n, d) from the SVD of the centered points."""
+    w = np.ones(len(points)) if weights is None else weights
+    centroid = (w[:, None] * points).sum(axis=0) / w.sum()
+    _, _, vt = np.linalg.svd(np.sqrt(w)[:, None] * (points - centroid), full_matrices=False)
+    normal = vt[-1]
+    return normal, -normal.dot(centroid)
+
+def fit_plane_robust(points, method='ransac', threshold=INLIER_THRESHOLD_MM, iterations=200, seed=0):
+    """
+    Fits a plane while down-weighting or excluding mis-clicked points.
+
+    Parameters:
+        points (array-like): An Nx3 array of XYZ coordinates.
+        method (str): 'ransac' (batched 3-point hypotheses, scored in one KxN pass, refit on the
+                      best inlier set), 'irls' (SVD refits with Tukey biweights) or 'lsq' (plain SVD).
+        threshold (float): Inlier distance in mm.
+        iterations (int): RANSAC hypotheses; all triplets are tried when there are fewer.
+
+    Returns:
+        dict: 'plane' (A, B, C, D) with a unit normal, 'inliers' (bool N), 'distances' (signed, N)
+              and 'rms' (RMS distance of the inliers, mm).
+    """
+    points = np.asarray(points, dtype=float)
+    n = len(points)
+    if n < 3:
+        raise ValueError("At least three points are required to define a plane.")
+
+    if method == 'lsq':
+        normal, d = _svd_plane(points)
+    elif method == 'irls':
+        weights = np.ones(n)
+        for _ in range(20):
+            normal, d = _svd_plane(points, weights)
+            r = points.dot(normal) + d
+            # Tukey biweight with a MAD scale (never below the inlier threshold)
+            scale = max(4.685 * np.median(np.abs(r)) / 0.6745, threshold)
+            new_weights = np.clip(1.0 - (r / scale) ** 2, 0.0, None) ** 2
+            if new_weights.sum() < 3 or np.allclose(new_weights, weights, atol=1e-6):
+                break
+            weights = new_weights
+    elif method == 'ransac':
+        rng = np.random.default_rng(seed)
+        if n * (n - 1) * (n - 2) // 6 <= iterations:
+            triplets = np.array([(i, j, k) for i in range(n) for j in range(i + 1, n) for k in range(j + 1, n)])
+        else:
+            triplets = np.argsort(rng.random((iterations, n)), axis=1)[:, :3]
+        p0, p1, p2 = (points[triplets[:, i]] for i in range(3))
+        normals = np.cross(p1 - p0, p2 - p0)
+        norms = np.linalg.norm(normals, axis=1)
+        valid = norms > 1e-9
+        if not valid.any():
+            raise ValueError("Points are collinear; no plane can be fitted.")
+        normals = normals[valid] / norms[valid, None]
+        ds = -np.einsum('ij,ij->i', normals, p0[valid])
+        # K hypotheses x N points in one pass
+        residuals = np.abs(normals.dot(points.T) + ds[:, None])
+        inlier_mask = residuals <= threshold
+        counts = inlier_mask.sum(axis=1)
+        cost = np.where(inlier_mask, residuals, 0.0).sum(axis=1)
+        best = np.lexsort((cost, -counts))[0]
+        best_inliers = inlier_mask[best]
+        normal, d = _svd_plane(points[best_inliers]) if best_inliers.sum() >= 3 else (normals[best], ds[best])
+    else:
+        raise ValueError(f"Unknown plane fitting method '{method}'.")
+
+    distances = points.dot(normal) + d
+    inliers = np.abs(distances) <= threshold
+    rms = float(np.sqrt(np.mean(distances[inliers] ** 2))) if inliers.any() else float('inf')
+    return {"plane": (normal[0], normal[1], normal[2], d), "inliers": inliers, "distances": distances, "rms": rms}
+
+def fit_ring_plane(pointsArray, prefix, method=None):
+    """
+    Plane through the 'prefix-i' points, or None if a robust fit rejects the point set.
+
+    method=None keeps fit_plane_to_points; 'ransac'/'irls'/'lsq' fit with fit_plane_robust and
+    reject sets with fewer than MIN_INLIERS points, fewer than max(MIN_INLIERS, MIN_INLIER_FRACTION * n)
+    inliers or an inlier RMS above MAX_RMS_MM.
+    """
+    if method is None:
+        return fit_plane_to_points(pointsArray)
+    if len(pointsArray) < MIN_INLIERS:
+        print(f"[{prefix}] Error: robust fit needs at least {MIN_INLIERS} '{prefix}-i' points, "
+              f"got {len(pointsArray)}; add ring fiducials or run without 'robust'.")
+        return None
+    fit = fit_plane_robust(pointsArray, method=method)
+    n_inliers = int(fit["inliers"].sum())
+    print(f"[{prefix}] plane fit ({method}): {n_inliers}/{len(pointsArray)} inliers, RMS {fit['rms']:.3f} mm")
+    outliers = np.flatnonzero(~fit["inliers"])
+    if len(outliers):
+        print(f"[{prefix}] outliers (sorted index: distance mm): "
+              + ", ".join(f"{i}: {fit['distances'][i]:.2f}" for i in outliers))
+    if n_inliers < max(MIN_INLIERS, MIN_INLIER_FRACTION * len(pointsArray)) or fit["rms"] > MAX_RMS_MM:
+        print(f"[{prefix}] point set rejected; check the '{prefix}-i' fiducials.")
+        return None
+    # Orient the normal as fit_plane_to_points does on the inliers alone (what method=None gives
+    # once the mis-clicks are removed), so outliers cannot flip the RING_OFFSET direction
+    A, B, C, D = fit["plane"]
+    sign = np.sign(np.dot([A, B, C], fit_plane_to_points(pointsArray[fit["inliers"]])[:3])) or 1.0
+    return (sign * A, sign * B, sign * C, sign * D)
+
+def get_labeled_points(markupNode, pointPrefixes):
+    """
+    Collect the 'prefix-i' control points of several prefixes in one pass over the labels.
+
+    Returns:
+        dict: prefix -> Nx3 array of world positions, sorted by i.
+    """
+    pattern = re.compile(r'^({})-(\d+)$'.format('|'.join(re.escape(p) for p in pointPrefixes)))
+    positions = slicer.util.arrayFromMarkupsControlPoints(markupNode, world=True)
+    found = {p: [] for p in pointPrefixes}
+    for idx in range(markupNode.GetNumberOfControlPoints()):
+        match = pattern.match(markupNode.GetNthControlPointLabel(idx))
+        if match:
+            found[match.group(1)].append((int(match.group(2)), idx))
+    return {p: positions[[idx for _, idx in sorted(items)]].reshape(-1, 3) for p, items in found.items()}
+
+def offset_plane_z(planes, xy, offset_distance=RING_OFFSET):
+    """
+    Z of the offset planes at all template positions in one broadcast.
+
+    Parameters:
+        planes (array-like): Kx4 plane coefficients (A, B, C, D) from fit_plane_to_points.
+        xy (array-like): Mx2 template positions.
+
+    Returns:
+        ndarray: KxM Z coordinates (row k: plane k offset by 'offset_distance' along its normal).
+    """
+    planes = np.atleast_2d(np.asarray(planes, dtype=float))
+    xy = np.atleast_2d(np.asarray(xy, dtype=float))
+    A, B, C, D = (planes[:, i:i + 1] for i in range(4))
+    D2 = offset_parallel_plane(A, B, C, D, offset_distance)
+    return (-D2 - A * xy[:, 0] - B * xy[:, 1]) / C
+
+def main_batch(markupName, pointPrefixes, targetName, xy, robust=None):
+    """
+    Targets for every (prefix, template position) pair, written to one markups node.
+
+    Labels are '<prefix>-target-<j>' with j the 1-based index in 'xy'.
+    robust selects a fit_plane_robust method; rejected prefixes are skipped.
+    """
+    markupNode = slicer.util.getNode(markupName)
+    xy = np.atleast_2d(np.asarray(xy, dtype=float))
+    labeledPoints = get_labeled_points(markupNode, pointPrefixes)
+
+    prefixes, planes = [], []
+    for prefix in pointPrefixes:
+        pointsArray = labeledPoints[prefix]
+        if len(pointsArray) < 3:
+            print(f"Only {len(pointsArray)} control points labeled '{prefix}-i' were found (minimum 3 required). Skipping.")
+            continue
+        plane = fit_ring_plane(pointsArray, prefix, robust)
+        if plane is None:
+            continue
+        prefixes.append(prefix)
+        planes.append(plane)
+    if not planes:
+        return None
+
+    Z = offset_plane_z(planes, xy, RING_OFFSET)
+    K, M = Z.shape
+    points = np.column_stack([np.tile(xy, (K, 1)), Z.reshape(-1)])
+    labels = [f"{prefix}-target-{j + 1}" for prefix in prefixes for j in range(M)]
+    create_or_update_markups(targetName, points, labels)
+    print(f"Computed {len(labels)} targets ({K} rings x {M} template positions) into '{targetName}'.")
+    return points
+
+
+# Live target state, kept in a module in sys.modules: every exec() of this script (usually
+# with a fresh script_globals dict) sees the same session, so a re-run stops the previous
+# observers instead of stacking a second set that rewrites the same target
+_state = sys.modules.setdefault("FitTarget2MaxDepth_state", types.ModuleType("FitTarget2MaxDepth_state"))
+_liveTarget = _state.__dict__.setdefault("liveTarget", {})
+
+def _scan_labels(state):
+    """Full rescan: control point index -> i for every 'prefix-i' label."""
+    markupNode, pattern = state["node"], state["pattern"]
+    state["labels"] = {}
+    for idx in range(markupNode.GetNumberOfControlPoints()):
+        match = pattern.match(markupNode.GetNthControlPointLabel(idx))
+        if match:
+            state["labels"][idx] = int(match.group(1))
+
+def _update_label(state, idx):
+    """Re-read a single control point label into the cache."""
+    match = state["pattern"].match(state["node"].GetNthControlPointLabel(idx))
+    if match:
+        state["labels"][idx] = int(match.group(1))
+    else:
+        state["labels"].pop(idx, None)
+
+def _shift_labels(state, start, step):
+    """Shift cached indices >= start by step (after an insert or a removal)."""
+    state["labels"] = {(idx + step if idx >= start else idx): i for idx, i in state["labels"].items()}
+
+def _flush_live_target():
+    state = _liveTarget
+    if not state:
+        return
+    state["pending"] = False
+    markupNode = state["node"]
+    n = markupNode.GetNumberOfControlPoints()
+    if state["rescan"] or any(idx >= n for idx in state["labels"]):
+        _scan_labels(state)
+        state["rescan"] = False
+
+    ordered = sorted(state["labels"].items(), key=lambda item: item[1])
+    if len(ordered) < 3:
+        print(f"Only {len(ordered)} control points labeled '{state['prefix']}-i' were found (minimum 3 required).")
+        return
+    pointsArray = np.zeros((len(ordered), 3))
+    pointWorld = [0.0, 0.0, 0.0]
+    for row, (idx, _) in enumerate(ordered):
+        markupNode.GetNthControlPointPositionWorld(idx, pointWorld)
+        pointsArray[row] = pointWorld
+    plane = fit_ring_plane(pointsArray, state["prefix"], state["robust"])
+    if plane is None:
+        return
+    x, y = state["x"], state["y"]
+    z = offset_plane_z(plane, [(x, y)], RING_OFFSET)[0, 0]
+    create_or_update_markup(state["targetName"], x, y, z)
+
+def _on_fiducials_modified(caller, event, idx):
+    state = _liveTarget
+    if not state:
+        return
+    if idx is None or idx < 0:
+        state["rescan"] = True
+    elif event == slicer.vtkMRMLMarkupsNode.PointAddedEvent:
+        if idx < caller.GetNumberOfControlPoints() - 1:
+            _shift_labels(state, idx, 1)
+        _update_label(state, idx)
+    elif event == slicer.vtkMRMLMarkupsNode.PointRemovedEvent:
+        state["labels"].pop(idx, None)
+        _shift_labels(state, idx + 1, -1)
+    else:
+        # Moves keep the label, but a rename also arrives as PointModifiedEvent
+        was_labeled = idx in state["labels"]
+        _update_label(state, idx)
+        if not was_labeled and idx not in state["labels"]:
+            return
+    _schedule_live_fit(state)
+
+def _on_transform_modified(caller, event):
+    # A (parent) transform change moves every point in world space; labels are unchanged
+    if _liveTarget:
+        _schedule_live_fit(_liveTarget)
+
+def _schedule_live_fit(state):
+    # Coalesce: many events in one event-loop turn (e.g. dragging) give one re-fit
+    if not state["pending"]:
+        state["pending"] = True
+        qt.QTimer.singleShot(0, _flush_live_target)
+
+def _fiducial_observer(event):
+    # Markups events reach Python unnamed, so each event gets its own callback;
+    # the call data is the control point index
+    @vtk.calldata_type(vtk.VTK_INT)
+    def callback(caller, eventName, idx):
+        _on_fiducials_modified(caller, event, idx)
+    return callback
+
+LIVE_EVENTS = (
+    slicer.vtkMRMLMarkupsNode.PointAddedEvent,
+    slicer.vtkMRMLMarkupsNode.PointModifiedEvent,
+    slicer.vtkMRMLMarkupsNode.PointRemovedEvent,
+)
+
+def start_live_target(markupName, pointPrefix, targetName, x, y, robust=None):
+    """
+    Re-fit the ring plane and move the target whenever a 'prefix-i' point is added, moved
+    or removed, or the markups node's transform changes. The index -> i label map is cached and patched per event; re-fits are
+    throttled to one per event-loop turn.
+    """
+    stop_live_target()
+    markupNode = slicer.util.getNode(markupName)
+    _liveTarget.update({
+        "node": markupNode, "prefix": pointPrefix, "targetName": targetName, "x": x, "y": y,
+        "robust": robust, "pattern": re.compile(r'^{}-(\d+)$'.format(re.escape(pointPrefix))),
+        "labels": {}, "pending": False, "rescan": False,
+    })
+    _scan_labels(_liveTarget)
+    _liveTarget["tags"] = [markupNode.AddObserver(e, _fiducial_observer(e)) for e in LIVE_EVENTS]
+    _liveTarget["tags"].append(markupNode.AddObserver(slicer.vtkMRMLTransformableNode.TransformModifiedEvent,
+                                                      _on_transform_modified))
+    _flush_live_target()
+    print(f"Live target enabled: '{targetName}' follows the '{pointPrefix}-i' points of '{markupName}'.")
+
+def stop_live_target():
+    """Remove the live observers; the target keeps its last position."""
+    if _liveTarget:
+        for tag in _liveTarget["tags"]:
+            _liveTarget["node"].RemoveObserver(tag)
+        print(f"Live target stopped for '{_liveTarget['targetName']}'.")
+    _liveTarget.clear()
+
+def main(markupName, pointPrefix, targetName, x, y, robust=None):
     # Your existing code that uses 'markupName', 'pointPrefix', 'targetName', 'x', and 'y'
     print(f"The markupName is: {markupName}")
     print(f"The pointPrefix is: {pointPrefix}")
@@ -165,7 +495,10 @@ def main(markupName, pointPrefix, targetName, x, y):
             
             # Now 'pointsArray' contains the coordinates of the markup points
             # Calculate the plane parameters
-            (A,B,C,D) = fit_plane_to_points(pointsArray)
+            plane = fit_ring_plane(pointsArray, pointPrefix, robust)
+            if plane is None:
+                return
+            (A,B,C,D) = plane
 
             # Apply RING_OFFSET to plane
             D2 = offset_parallel_plane(A, B, C, D, RING_OFFSET)
@@ -202,10 +535,43 @@ try:
 except NameError:
     y = None
 
-if None in (markupName, pointPrefix, targetName, x, y):
+try:
+    pointPrefixes
+except NameError:
+    pointPrefixes = None
+
+try:
+    xy
+except NameError:
+    xy = None
+
+try:
+    robustFit
+except NameError:
+    robustFit = None
+
+try:
+    live
+except NameError:
+    live = False
+
+if xy is not None or pointPrefixes is not None:
+    # Batch mode: several template positions and/or several prefixes
+    prefixes = pointPrefixes or ([pointPrefix] if pointPrefix else None)
+    positions = xy if xy is not None else ([(x, y)] if None not in (x, y) else None)
+    if None in (markupName, targetName, prefixes, positions):
+        print("Error: Missing one or more inputs.")
+        print("Please define 'markupName', 'pointPrefixes' (or 'pointPrefix'), 'targetName' and 'xy' (or 'x' and 'y') before executing the script.")
+    else:
+        if live:
+            print("[WARN] 'live' is not supported in batch mode (pointPrefixes/xy); computing the targets once.")
+        main_batch(markupName, prefixes, targetName, positions, robustFit)
+elif None in (markupName, pointPrefix, targetName, x, y):
     # Handle the case where inputs are not provided
     print("Error: Missing one or more inputs.")
     print("Please define 'markupName', pointPrefix, 'targetName', 'x', and 'y' before executing the script.")
+elif live:
+    start_live_target(markupName, pointPrefix, targetName, x, y, robustFit)
 else:
     # Call the main function with the inputs
-    main(markupName, pointPrefix, targetName, x, y)
+    main(markupName, pointPrefix, targetName, x, y, robustFit)
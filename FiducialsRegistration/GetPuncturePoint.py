@@ -6,6 +6,9 @@ filePath = "/home/mariana/SlicerScripts/FiducialsRegistration/GetPuncturePoint.p
 
 # Define the variable to pass
 script_globals = {'worldPoints': 'WaxPaperPoints', 'outputName': 'P6w', 'p1': (3140,2106), 'p2': (3687,4601), 'p3': (1522,3227), 'p4': (2748,3343)}
+# Batch: many puncture pixels from one photo into a single markups node (labels P6w-1, P6w-2, ...)
+script_globals = {'worldPoints': 'WaxPaperPoints', 'outputName': 'P6w', 'p1': (3140,2106), 'p2': (3687,4601), 'p3': (1522,3227),
+                  'p4s': [(2748,3343), (2801,3290), (2690,3402)]}
 
 # Execute the script with the provided globals
 exec(open(filePath, encoding='utf-8').read(), script_globals)
@@ -40,6 +43,53 @@ def create_or_update_markup(outputName, P4):
     # Add a single control point
     pointIndex = markupNode.AddControlPoint(P4)
     markupNode.SetNthControlPointLabel(pointIndex, outputName)
+
+def create_or_update_markups(outputName, points, labels):
+    """Replace the control points of 'outputName' (created if missing) with 'points' (Nx3) in one bulk update."""
+    nodes = slicer.mrmlScene.GetNodesByClassByName('vtkMRMLMarkupsFiducialNode', outputName)
+    markupNode = nodes.GetItemAsObject(0) if nodes.GetNumberOfItems() else None
+    if not markupNode:
+        markupNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', outputName)
+        print(f"Created new markup node with name '{outputName}'.")
+
+    # Set all points at once, then their labels, inside one modify block
+    wasModifying = markupNode.StartModify()
+    try:
+        slicer.util.updateMarkupsControlPointsFromArray(markupNode, np.asarray(points, dtype=float).reshape(-1, 3))
+        for idx, label in enumerate(labels):
+            markupNode.SetNthControlPointLabel(idx, label)
+    finally:
+        markupNode.EndModify(wasModifying)
+    return markupNode
+
+def pixel_to_world_matrix(P1, P2, P3, p1, p2, p3):
+    """
+    3x3 matrix M mapping homogeneous pixels [x, y, 1] to 3D points on the plane of P1, P2, P3
+    (same affine model as calculate_4th_point_3d, with the 2x2 system inverted once).
+    """
+    P1, P2, P3 = (np.asarray(P, dtype=float) for P in (P1, P2, P3))
+    p1, p2, p3 = (np.asarray(p, dtype=float) for p in (p1, p2, p3))
+
+    # Pixel offsets of p2, p3 from p1 (columns) and the matching 3D basis vectors u, v
+    A = np.column_stack([p2 - p1, p3 - p1])
+    if np.linalg.det(A) == 0:
+        raise ValueError("The affine transformation matrix is singular and cannot be inverted.")
+    L = np.column_stack([P2 - P1, P3 - P1]).dot(np.linalg.inv(A))
+    return np.column_stack([L, P1 - L.dot(p1)])
+
+def calculate_points_3d(P1, P2, P3, p1, p2, p3, pixels):
+    """
+    Map many pixels to 3D with a single matrix multiply.
+
+    Parameters:
+        pixels: Nx2 array or list of pixel coordinates.
+
+    Returns:
+        Numpy Nx3 array of 3D coordinates.
+    """
+    pixels = np.asarray(pixels, dtype=float).reshape(-1, 2)
+    M = pixel_to_world_matrix(P1, P2, P3, p1, p2, p3)
+    return np.column_stack([pixels, np.ones(len(pixels))]).dot(M.T)
     
     
 def calculate_4th_point_3d(P1, P2, P3, p1, p2, p3, p4):
@@ -97,6 +147,27 @@ def calculate_4th_point_3d(P1, P2, P3, p1, p2, p3, p4):
     
     return P4
 
+def get_world_points(worldNode):
+    """The 3 control points of worldNode as a 3x3 array, or None if it does not have exactly 3."""
+    nControlPoints = worldNode.GetNumberOfControlPoints()
+    if nControlPoints != 3:
+        print(f"Number of worldPoints should be 3 ({nControlPoints} found).")
+        return None
+    return slicer.util.arrayFromMarkupsControlPoints(worldNode, world=True)
+
+def main_batch(worldPoints, outputName, p1, p2, p3, p4s):
+    """Map every pixel in p4s to 3D and write them all to 'outputName' (labels <outputName>-<j>)."""
+    print(f"The worldPoints is: {worldPoints}")
+    worldNode = slicer.util.getNode(worldPoints)
+    P = get_world_points(worldNode)
+    if P is None:
+        return None
+
+    points = calculate_points_3d(P[0], P[1], P[2], p1, p2, p3, p4s)
+    create_or_update_markups(outputName, points, [f"{outputName}-{j + 1}" for j in range(len(points))])
+    print(f"Computed {len(points)} puncture points into '{outputName}'.")
+    return points
+
 def main(worldPoints, outputName, p1, p2, p3, p4):
     # Your existing code that uses 'worldPoints'and 'pixelPoints'
     print(f"The worldPoints is: {worldPoints}")
@@ -161,7 +232,18 @@ try:
 except NameError:
     p4 = None
 
-if None in (worldPoints, outputName, p1, p2, p3, p4):
+try:
+    p4s
+except NameError:
+    p4s = None
+
+if p4s is not None:
+    if None in (worldPoints, outputName, p1, p2, p3):
+        print("Error: Missing one or more inputs.")
+        print("Please define 'worldPoints', outputName, 'p1', 'p2', 'p3', and 'p4s' before executing the script.")
+    else:
+        main_batch(worldPoints, outputName, p1, p2, p3, p4s)
+elif None in (worldPoints, outputName, p1, p2, p3, p4):
     # Handle the case where inputs are not provided
     print("Error: Missing one or more inputs.")
     print("Please define 'worldPoints', outputName, 'p1', 'p2', 'p3', and 'p4' before executing the script.")
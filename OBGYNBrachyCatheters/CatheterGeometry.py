@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+CatheterGeometry.py
+
+Slicer-free catheter geometry shared by LoadCatheters.py and CreateCatheter3DModels.py
+(CSV reading, polyline, spline resampling and tube surface, plain VTK/NumPy).
+Run directly, it reads R{i}.csv / C{i}.csv trajectories and writes one mesh per catheter
+plus a summary table.
+
+python3 CatheterGeometry.py /home/mariana/Experiments/2025-08-21_Pig2/trajectories_csv \
+--prefix R C \
+--out meshes \
+--format vtp \
+--summary catheters.csv \
+--workers 8
+
+Summary columns: catheter, n_points, length_mm, mean/max curvature (1/mm) along the
+resampled path, and the tip position (first control point; --tip last for the last one).
+"""
+import os
+import re
+import csv
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+try:
+    import vtk
+    from vtk.util import numpy_support
+except Exception:
+    print("ERROR: vtk is required. Install with: pip install vtk", file=sys.stderr)
+    raise
+
+REQUIRED_COLS = ['label', 'r', 'a', 's']  # defined/selected/visible/locked are optional
+
+# Levels of detail: tube sides and curvature-adaptive sampling
+# (a sample is kept once the path has turned max_angle_deg or run max_length_mm since the last one)
+LOD_LEVELS = {
+    "high":   {"sides": 16, "max_angle_deg": 2.0,  "max_length_mm": 2.0},
+    "medium": {"sides": 8,  "max_angle_deg": 5.0,  "max_length_mm": 5.0},
+    "low":    {"sides": 6,  "max_angle_deg": 10.0, "max_length_mm": 10.0},
+}
+
+def read_catheter_csv(csv_path, base=None):
+    """
+    Read a catheter CSV (label, r, a, s, ...).
+
+    Returns:
+        (ndarray, list): Nx3 RAS positions and N labels (empty labels become '<base>_<row>';
+        base defaults to the file name without extension).
+
+    Raises:
+        ValueError: If a required column is missing or a coordinate is not numeric.
+    """
+    if base is None:
+        base = os.path.splitext(os.path.basename(csv_path))[0]
+    with open(csv_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = [h.strip() for h in next(reader, [])]
+        missing = [name for name in REQUIRED_COLS if name not in header]
+        if missing:
+            raise ValueError(f"Missing required column(s) {missing}")
+        cols = [header.index(name) for name in REQUIRED_COLS]
+        rows = [[row[c] for c in cols] for row in reader if row]
+
+    if not rows:
+        return np.zeros((0, 3)), []
+
+    table = np.array(rows, dtype=object)
+    points = table[:, 1:4].astype(float)
+    labels = [str(lbl).strip() or f"{base}_{row+1}" for row, lbl in enumerate(table[:, 0])]
+    return points, labels
+
+def set_polyline_points(poly, points):
+    """Make 'poly' a single polyline through points (Nx3), in place (keeps pipeline connections)."""
+    vpts = vtk.vtkPoints()
+    vpts.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(points, dtype=float), deep=True))
+    lines = vtk.vtkCellArray()
+    lines.InsertNextCell(len(points))
+    for i in range(len(points)):
+        lines.InsertCellPoint(i)
+    poly.SetPoints(vpts)
+    poly.SetLines(lines)
+    poly.Modified()
+
+def polyline_from_points(points):
+    poly = vtk.vtkPolyData()
+    set_polyline_points(poly, points)
+    return poly
+
+def spline_resample(poly, length_mm=0.5):
+    spline = vtk.vtkSplineFilter()
+    spline.SetInputData(poly)
+    spline.SetSubdivideToLength()
+    spline.SetLength(length_mm)
+    spline.Update()
+    return spline.GetOutput()
+
+def adaptive_resample(poly, max_angle_deg=5.0, max_length_mm=5.0, dense_length_mm=0.5):
+    """
+    Curvature-adaptive resampling: spline at dense_length_mm, then keep only the samples where
+    the accumulated turning angle reaches max_angle_deg or the run length max_length_mm.
+    Straight stretches collapse to few points; bends keep the dense sampling.
+    """
+    dense = spline_resample(poly, dense_length_mm)
+    pts = numpy_support.vtk_to_numpy(dense.GetPoints().GetData())
+    if len(pts) < 3:
+        return dense
+
+    seg = np.diff(pts, axis=0)
+    seg_len = np.linalg.norm(seg, axis=1)
+    dirs = seg / np.maximum(seg_len, 1e-12)[:, None]
+    # Turning angle at interior sample i+1, between segments i and i+1
+    turn = np.degrees(np.arccos(np.clip(np.einsum('ij,ij->i', dirs[:-1], dirs[1:]), -1.0, 1.0)))
+
+    keep = [0]
+    angle = length = 0.0
+    for i in range(1, len(pts) - 1):
+        angle += turn[i - 1]
+        length += seg_len[i - 1]
+        if angle >= max_angle_deg or length + seg_len[i] > max_length_mm:
+            keep.append(i)
+            angle = length = 0.0
+    keep.append(len(pts) - 1)
+    return polyline_from_points(pts[keep])
+
+def tube_filter(radius_mm=0.6, sides=16):
+    """Capped vtkTubeFilter with the catheter radius (mm) and number of sides."""
+    tube = vtk.vtkTubeFilter()
+    tube.SetRadius(radius_mm)
+    tube.SetNumberOfSides(sides)
+    tube.SetCapping(True)
+    return tube
+
+def tube_pipeline(radius_mm=0.6, sides=16, spline_mm=0.5):
+    """
+    Persistent polyline -> vtkSplineFilter -> vtkTubeFilter pipeline.
+
+    Returns:
+        (vtkPolyData, vtkSplineFilter, vtkTubeFilter): The input polyline (fill it with
+        set_polyline_points), the spline resampling every spline_mm and the tube surface.
+    """
+    poly = vtk.vtkPolyData()
+    spline = vtk.vtkSplineFilter()
+    spline.SetInputData(poly)
+    spline.SetSubdivideToLength()
+    spline.SetLength(spline_mm)
+    tube = tube_filter(radius_mm, sides)
+    tube.SetInputConnection(spline.GetOutputPort())
+    return poly, spline, tube
+
+def build_tube(points, radius_mm=0.6, sides=16, spline_mm=0.5, lod=None):
+    """
+    Spline-resampled path and tube surface through points (Nx3, at least 2).
+
+    lod=None resamples every spline_mm with 'sides' sides; a LOD_LEVELS key uses
+    curvature-adaptive sampling and that level's number of sides.
+
+    Returns:
+        (ndarray, vtkPolyData): Resampled path points (Mx3) and the capped tube surface.
+    """
+    if lod is None:
+        poly, spline, tube = tube_pipeline(radius_mm, sides, spline_mm)
+        set_polyline_points(poly, points)
+        tube.Update()
+        path = spline.GetOutput()
+    else:
+        level = LOD_LEVELS[lod]
+        path = adaptive_resample(polyline_from_points(points), level["max_angle_deg"],
+                                 level["max_length_mm"], spline_mm)
+        tube = tube_filter(radius_mm, level["sides"])
+        tube.SetInputData(path)
+        tube.Update()
+    return numpy_support.vtk_to_numpy(path.GetPoints().GetData()).copy(), tube.GetOutput()
+
+def path_metrics(path):
+    """Length (mm) and discrete curvature (turning angle / mean adjacent segment length, 1/mm)."""
+    seg = np.diff(path, axis=0)
+    seg_len = np.linalg.norm(seg, axis=1)
+    length = float(seg_len.sum())
+    if len(path) < 3:
+        return length, 0.0, 0.0
+    dirs = seg / np.maximum(seg_len, 1e-12)[:, None]
+    angle = np.arccos(np.clip(np.einsum('ij,ij->i', dirs[:-1], dirs[1:]), -1.0, 1.0))
+    curvature = angle / np.maximum(0.5 * (seg_len[:-1] + seg_len[1:]), 1e-12)
+    return length, float(curvature.mean()), float(curvature.max())
+
+def write_mesh(poly, path, fmt):
+    if fmt == "stl":
+        tri = vtk.vtkTriangleFilter()
+        tri.SetInputData(poly)
+        tri.Update()
+        writer = vtk.vtkSTLWriter()
+        writer.SetInputData(tri.GetOutput())
+    else:
+        writer = vtk.vtkXMLPolyDataWriter()
+        writer.SetInputData(poly)
+    writer.SetFileName(path)
+    if not writer.Write():
+        raise IOError(f"Could not write {path}")
+
+def process_catheter(csv_path, out_dir=None, fmt="vtp", radius_mm=0.6, sides=16, tip="first"):
+    """Build, write and measure one catheter; returns its summary row."""
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    points, _ = read_catheter_csv(csv_path)
+    if len(points) < 2:
+        raise ValueError(f"need at least 2 points, got {len(points)}")
+
+    path, tube = build_tube(points, radius_mm=radius_mm, sides=sides)
+    mesh_path = ""
+    if out_dir:
+        mesh_path = os.path.join(out_dir, f"{name}_model.{fmt}")
+        write_mesh(tube, mesh_path, fmt)
+
+    length, mean_k, max_k = path_metrics(path)
+    tip_pt = points[0] if tip == "first" else points[-1]
+    return {
+        "catheter": name, "n_points": len(points), "length_mm": length,
+        "mean_curvature_per_mm": mean_k, "max_curvature_per_mm": max_k,
+        "tip_r": float(tip_pt[0]), "tip_a": float(tip_pt[1]), "tip_s": float(tip_pt[2]),
+        "mesh": mesh_path,
+    }
+
+def find_catheter_files(folder, prefixes):
+    """{prefix}{i}.csv files in folder, sorted by prefix then index."""
+    pattern = re.compile(r"^({})(\d+)\.csv$".format("|".join(re.escape(p) for p in prefixes)))
+    found = []
+    for fname in os.listdir(folder):
+        m = pattern.match(fname)
+        if m:
+            found.append((prefixes.index(m.group(1)), int(m.group(2)), os.path.join(folder, fname)))
+    return [p for _, _, p in sorted(found)]
+
+def _run(args_tuple):
+    csv_path, kwargs = args_tuple
+    try:
+        return process_catheter(csv_path, **kwargs), None
+    except Exception as e:
+        return None, f"{os.path.basename(csv_path)}: {e}"
+
+def main():
+    ap = argparse.ArgumentParser(description="Build catheter tube meshes and geometry summaries from trajectory CSVs (no Slicer).")
+    ap.add_argument("folder", help="Folder containing {prefix}{i}.csv trajectories")
+    ap.add_argument("--prefix", nargs="*", default=["R", "C"], help="File name prefixes (default: R C)")
+    ap.add_argument("--out", default=None, help="Output folder for meshes (omit to only compute the summary)")
+    ap.add_argument("--format", choices=["vtp", "stl"], default="vtp", help="Mesh format")
+    ap.add_argument("--radius", type=float, default=0.6, help="Tube radius in mm (default 0.6)")
+    ap.add_argument("--sides", type=int, default=16, help="Tube sides (default 16)")
+    ap.add_argument("--tip", choices=["first", "last"], default="first", help="Control point reported as the tip")
+    ap.add_argument("--summary", default=None, help="Output CSV path for per-catheter geometry")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    args = ap.parse_args()
+
+    files = find_catheter_files(args.folder, args.prefix)
+    print(f"Found {len(files)} catheter files.")
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+
+    kwargs = {"out_dir": args.out, "fmt": args.format, "radius_mm": args.radius, "sides": args.sides, "tip": args.tip}
+    jobs = [(p, kwargs) for p in files]
+    if args.workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(_run, jobs))
+    else:
+        results = [_run(j) for j in jobs]
+
+    rows = []
+    for row, err in results:
+        if err:
+            print(f"[WARN] {err} — skipping.")
+        else:
+            rows.append(row)
+            print(f"[OK] {row['catheter']}: {row['n_points']} points, {row['length_mm']:.1f} mm, "
+                  f"max curvature {row['max_curvature_per_mm']:.3f} 1/mm")
+
+    if args.summary:
+        with open(args.summary, "w", newline="") as f:
+            w = csv.DictWriter(f, fieldnames=["catheter", "n_points", "length_mm", "mean_curvature_per_mm",
+                                              "max_curvature_per_mm", "tip_r", "tip_a", "tip_s", "mesh"])
+            w.writeheader()
+            w.writerows(rows)
+        print(f"Wrote summary CSV: {args.summary}")
+
+if __name__ == "__main__":
+    main()
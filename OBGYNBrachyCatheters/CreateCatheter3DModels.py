@@ -6,57 +6,118 @@ filePath = "/home/mariana/SlicerScripts/OBGYNBrachyCatheters/CreateCatheter3DMod
 
 # Define the variable to pass
 script_globals = {'N': 8, 'prefix': 'T', 'radius_mm': 0.6}
+# Optional: a single model 'T_model' with all catheters (per-catheter colors via a CatheterID scalar)
+script_globals = {'N': 8, 'prefix': 'T', 'radius_mm': 0.6, 'merged': True}
+# Optional: curvature-adaptive level of detail ('high'|'medium'|'low'), globally or per view
+script_globals = {'N': 8, 'prefix': 'T', 'lod': 'medium'}
+script_globals = {'N': 8, 'prefix': 'T', 'lodViews': {'high': ['vtkMRMLViewNode1'],
+                                                      'low': ['vtkMRMLSliceNodeRed', 'vtkMRMLSliceNodeGreen', 'vtkMRMLSliceNodeYellow']}}
+# Report triangle counts and render time per level of detail
+script_globals = {'N': 8, 'prefix': 'T', 'lodReport': True}
+# Live models: T1_model..T8_model follow control point edits until stopped
+script_globals = {'N': 8, 'prefix': 'T', 'live': True}
+script_globals['stop_live_catheters']()
+# Spatial queries: nearest catheter / catheters within X mm (kept up to date on point edits)
+script_globals = {'N': 8, 'prefix': 'T', 'locator': True}
+# CatheterGeometry.py is imported from filePath's folder; without filePath, pass this script's path
+# script_globals['scriptPath'] = '/path/to/OBGYNBrachyCatheters/CreateCatheter3DModels.py'
 
 # Execute the script with the provided globals
 exec(open(filePath, encoding='utf-8').read(), script_globals)
 
+# With 'locator': points is a Px3 array of RAS positions
+ids, dist, closest = script_globals['catheterLocator'].nearest(points)
+nearby = script_globals['catheterLocator'].within(points, 5.0)
+
 """
 
 
+import os
+import sys
+import types
+import time
+import colorsys
+import numpy as np
 import slicer, vtk
+from vtk.util import numpy_support
+
+# CatheterGeometry.py (next to this script) holds the shared Slicer-free catheter code. exec()
+# gives the script no __file__, so its folder comes from the 'scriptPath' global or, as in the
+# usage snippet, the 'filePath' defined in the Python console
+try:
+    import CatheterGeometry
+except ImportError:
+    import __main__
+    _scriptFile = globals().get("scriptPath") or getattr(__main__, "filePath", None)
+    if not _scriptFile:
+        raise ImportError("CatheterGeometry.py not found: define 'filePath' (the script path) in the console "
+                          "or pass 'scriptPath' in script_globals.")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(_scriptFile)))
+    import CatheterGeometry
+
+# Qt from the script globals when Slicer passes it, else Slicer's PythonQt module
+try:
+    qt
+except NameError:
+    import qt
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+CATHETER_ID_ARRAY = "CatheterID"
+
+def markups_points(markupsNode):
+    """Nx3 world positions of a Markups node's control points."""
+    return slicer.util.arrayFromMarkupsControlPoints(markupsNode, world=True)
+
+def build_tube_polydata(markupsNode, radius_mm=0.6, sides=16, lod=None):
+    """
+    Resampled tube surface (vtkPolyData) along a Markups fiducial node, or None if < 2 points.
+
+    lod=None keeps the fixed 0.5 mm spline sampling with 'sides' sides; a LOD_LEVELS key uses
+    curvature-adaptive sampling and that level's number of sides (see CatheterGeometry.build_tube).
+    """
+    if markupsNode.GetNumberOfControlPoints() < 2:
+        return None
+    return CatheterGeometry.build_tube(markups_points(markupsNode), radius_mm=radius_mm, sides=sides, lod=lod)[1]
+
+def count_triangles(poly):
+    """Triangles needed to render a tube surface (strips and polygons)."""
+    tri = vtk.vtkTriangleFilter()
+    tri.SetInputData(poly)
+    tri.PassLinesOff()
+    tri.PassVertsOff()
+    tri.Update()
+    return tri.GetOutput().GetNumberOfCells()
+
+def get_or_create_node(className, name):
+    """Reuse the first node of 'className' named 'name', so re-running updates instead of duplicating."""
+    nodes = slicer.mrmlScene.GetNodesByClassByName(className, name)
+    node = nodes.GetItemAsObject(0) if nodes.GetNumberOfItems() else None
+    return node or slicer.mrmlScene.AddNewNodeByClass(className, name)
+
+def set_view_node_ids(displayNode, view_node_ids=None):
+    """Restrict a display node to the given view node IDs (None shows it in all views)."""
+    displayNode.RemoveAllViewNodeIDs()
+    for view_id in view_node_ids or []:
+        displayNode.AddViewNodeID(view_id)
 
 def build_tube_model_from_fiducials(markupsNode, modelName,
                                     radius_mm=0.6, sides=16,
                                     color=(1.0, 0.2, 0.2), opacity=1.0,
-                                    show_in_slice=True):
+                                    show_in_slice=True, lod=None, view_node_ids=None):
     """Create a tube surface model from a Markups fiducial node."""
     n = markupsNode.GetNumberOfControlPoints()
-    if n < 2:
+    tube_poly = build_tube_polydata(markupsNode, radius_mm=radius_mm, sides=sides, lod=lod)
+    if tube_poly is None:
         print(f"[WARN] {modelName}: need at least 2 points, got {n}. Skipping.")
         return None
 
-    # Polyline from points
-    pts = vtk.vtkPoints()
-    lines = vtk.vtkCellArray()
-    lines.InsertNextCell(n)
-    for i in range(n):
-        p = [0.0, 0.0, 0.0]
-        markupsNode.GetNthControlPointPositionWorld(i, p)
-        pid = pts.InsertNextPoint(p)
-        lines.InsertCellPoint(pid)
-
-    poly = vtk.vtkPolyData()
-    poly.SetPoints(pts)
-    poly.SetLines(lines)
-
-    # Optional smoothing/resampling (comment out if you want exact segments)
-    spline = vtk.vtkSplineFilter()
-    spline.SetInputData(poly)
-    spline.SetSubdivideToLength()
-    spline.SetLength(0.5)  # resample every 0.5 mm; adjust as needed
-    spline.Update()
-
-    # Tube surface
-    tube = vtk.vtkTubeFilter()
-    tube.SetInputConnection(spline.GetOutputPort())
-    tube.SetRadius(radius_mm)     # catheter radius in mm
-    tube.SetNumberOfSides(sides)  # roundness
-    tube.SetCapping(True)
-    tube.Update()
-
-    # Model node in scene
-    modelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', modelName)
-    modelNode.SetAndObservePolyData(tube.GetOutput())
+    # Model node in scene (updated in place if it already exists)
+    modelNode = get_or_create_node('vtkMRMLModelNode', modelName)
+    modelNode.SetAndObservePolyData(tube_poly)
     if not modelNode.GetDisplayNode():
         modelNode.CreateDefaultDisplayNodes()
     d = modelNode.GetDisplayNode()
@@ -66,12 +127,390 @@ def build_tube_model_from_fiducials(markupsNode, modelName,
     # Show in slice views as intersection (optional)
     if show_in_slice:
         d.SetVisibility2D(True)
+    set_view_node_ids(d, view_node_ids)
 
     print(f"[OK] Created model '{modelName}' with {n} points, radius {radius_mm} mm.")
     return modelNode
 
-def main(N, prefix='C', radius_mm=0.6):
-    """Find Markups nodes named C1..CN and create tube models named C1_model..CN_model."""
+def catheter_color(catheter_id):
+    """Golden-ratio hue steps so neighbouring catheter IDs stay distinguishable."""
+    return colorsys.hsv_to_rgb(((catheter_id - 1) * 0.618034) % 1.0, 0.8, 1.0)
+
+def catheter_model_color(markupsNode, catheter_id):
+    """Color of the catheter's existing '<name>_model' tube, else catheter_color(catheter_id)."""
+    nodes = slicer.mrmlScene.GetNodesByClassByName('vtkMRMLModelNode', f"{markupsNode.GetName()}_model")
+    modelNode = nodes.GetItemAsObject(0) if nodes.GetNumberOfItems() else None
+    displayNode = modelNode.GetDisplayNode() if modelNode else None
+    return tuple(displayNode.GetColor()) if displayNode else catheter_color(catheter_id)
+
+def build_merged_catheter_model(catheters, modelName, radius_mm=0.6, sides=16,
+                                opacity=1.0, show_in_slice=True, lod=None, view_node_ids=None):
+    """
+    Append all catheter tubes into one model node.
+
+    Parameters:
+        catheters (list): (catheter_id, markupsNode) pairs; IDs are positive integers.
+
+    Each cell carries its catheter ID in the 'CatheterID' cell array, colored through a
+    color table node with one entry per ID (catheter_model_color), so a single
+    display node renders all catheters.
+    Use show_only_catheters / highlight_catheter to isolate or emphasize catheters.
+    """
+    append = vtk.vtkAppendPolyData()
+    names = {}
+    colors = {}
+    for catheter_id, markupsNode in catheters:
+        tube_poly = build_tube_polydata(markupsNode, radius_mm=radius_mm, sides=sides, lod=lod)
+        if tube_poly is None:
+            print(f"[WARN] {markupsNode.GetName()}: need at least 2 points. Skipping.")
+            continue
+        ids = vtk.vtkIntArray()
+        ids.SetName(CATHETER_ID_ARRAY)
+        ids.SetNumberOfTuples(tube_poly.GetNumberOfCells())
+        ids.Fill(catheter_id)
+        tube_poly.GetCellData().AddArray(ids)
+        append.AddInputData(tube_poly)
+        names[catheter_id] = markupsNode.GetName()
+        colors[catheter_id] = catheter_model_color(markupsNode, catheter_id)
+
+    if not names:
+        print(f"[WARN] {modelName}: no catheters with at least 2 points.")
+        return None
+    append.Update()
+
+    # One color entry per catheter ID, in each catheter's own display color (0 = unused)
+    max_id = max(names)
+    colorNode = get_or_create_node('vtkMRMLColorTableNode', f"{modelName}_colors")
+    colorNode.SetTypeToUser()
+    colorNode.SetNumberOfColors(max_id + 1)
+    colorNode.SetColor(0, "none", 0.0, 0.0, 0.0, 0.0)
+    for catheter_id in range(1, max_id + 1):
+        r, g, b = colors.get(catheter_id, catheter_color(catheter_id))
+        colorNode.SetColor(catheter_id, names.get(catheter_id, f"unused_{catheter_id}"), r, g, b, 1.0)
+
+    modelNode = get_or_create_node('vtkMRMLModelNode', modelName)
+    modelNode.SetAndObservePolyData(append.GetOutput())
+    if not modelNode.GetDisplayNode():
+        modelNode.CreateDefaultDisplayNodes()
+    d = modelNode.GetDisplayNode()
+    d.SetActiveScalar(CATHETER_ID_ARRAY, vtk.vtkAssignAttribute.CELL_DATA)
+    d.SetAndObserveColorNodeID(colorNode.GetID())
+    d.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseColorNodeScalarRange)
+    d.SetScalarVisibility(True)
+    d.SetOpacity(opacity)
+    d.SetVisibility(True)
+    if show_in_slice:
+        d.SetVisibility2D(True)
+    set_view_node_ids(d, view_node_ids)
+
+    print(f"[OK] Created merged model '{modelName}' with {len(names)} catheters, radius {radius_mm} mm.")
+    return modelNode
+
+def show_only_catheters(modelNode, first_id=None, last_id=None):
+    """Threshold the merged model to catheter IDs in [first_id, last_id]; no IDs shows all."""
+    d = modelNode.GetDisplayNode()
+    if first_id is None:
+        d.SetThresholdEnabled(False)
+        return
+    d.SetThresholdRange(first_id - 0.5, (last_id if last_id is not None else first_id) + 0.5)
+    d.SetThresholdEnabled(True)
+
+def highlight_catheter(modelNode, catheter_id=None, dim_opacity=0.15):
+    """Dim every catheter but 'catheter_id' through the color table; None restores all."""
+    colorNode = modelNode.GetDisplayNode().GetColorNode()
+    rgba = [0.0, 0.0, 0.0, 0.0]
+    for i in range(1, colorNode.GetNumberOfColors()):
+        colorNode.GetColor(i, rgba)
+        alpha = 1.0 if catheter_id is None or i == catheter_id else dim_opacity
+        colorNode.SetColor(i, rgba[0], rgba[1], rgba[2], alpha)
+
+# Live catheter pipelines (markups node ID -> state), kept in a module in sys.modules: every
+# exec() of this script (usually with a fresh script_globals dict) sees the same registry, so
+# a re-run replaces the observers and pipelines instead of stacking them
+_state = sys.modules.setdefault("CreateCatheter3DModels_state", types.ModuleType("CreateCatheter3DModels_state"))
+_liveCatheters = _state.__dict__.setdefault("liveCatheters", {})
+_pendingLiveUpdates = _state.__dict__.setdefault("pendingLiveUpdates", set())
+
+LIVE_EVENTS = (
+    slicer.vtkMRMLMarkupsNode.PointModifiedEvent,
+    slicer.vtkMRMLMarkupsNode.PointAddedEvent,
+    slicer.vtkMRMLMarkupsNode.PointRemovedEvent,
+    slicer.vtkMRMLTransformableNode.TransformModifiedEvent,
+)
+
+def _update_live_polyline(state):
+    """Copy the current control points into the persistent pipeline input."""
+    pts = markups_points(state["markups"])
+    poly = state["poly"]
+    if len(pts) < 2:
+        # Too few points for a tube: show nothing until more are placed
+        poly.Initialize()
+        state["model"].GetDisplayNode().SetVisibility(False)
+        return
+    CatheterGeometry.set_polyline_points(poly, pts)
+    state["model"].GetDisplayNode().SetVisibility(True)
+
+def _flush_live_updates():
+    pending = list(_pendingLiveUpdates)
+    _pendingLiveUpdates.clear()
+    for node_id in pending:
+        state = _liveCatheters.get(node_id)
+        if state:
+            _update_live_polyline(state)
+
+def _on_catheter_modified(caller, event):
+    # Coalesce: many events in one event-loop turn (e.g. dragging) give one update
+    if not _pendingLiveUpdates:
+        qt.QTimer.singleShot(0, _flush_live_updates)
+    _pendingLiveUpdates.add(caller.GetID())
+
+def start_live_catheters(catheters, radius_mm=0.6, sides=16, suffix="_model"):
+    """
+    Keep <name>_model tubes in sync with their Markups nodes.
+
+    Each catheter gets a persistent CatheterGeometry.tube_pipeline feeding its model node
+    through a pipeline connection; point add/move/remove events only refresh that catheter's
+    input polyline, coalesced to one update per event-loop turn.
+    """
+    stop_live_catheters()
+    for catheter_id, markupsNode in catheters:
+        poly, spline, tube = CatheterGeometry.tube_pipeline(radius_mm, sides)
+
+        color = catheter_model_color(markupsNode, catheter_id)
+        modelNode = get_or_create_node('vtkMRMLModelNode', f"{markupsNode.GetName()}{suffix}")
+        if not modelNode.GetDisplayNode():
+            modelNode.CreateDefaultDisplayNodes()
+            modelNode.GetDisplayNode().SetColor(*color)
+        modelNode.GetDisplayNode().SetVisibility2D(True)
+
+        state = {"markups": markupsNode, "model": modelNode, "poly": poly, "spline": spline, "tube": tube}
+        _update_live_polyline(state)
+        modelNode.SetPolyDataConnection(tube.GetOutputPort())
+        state["observers"] = [markupsNode.AddObserver(e, _on_catheter_modified) for e in LIVE_EVENTS]
+        _liveCatheters[markupsNode.GetID()] = state
+    print(f"[OK] Live update enabled for {len(_liveCatheters)} catheter models.")
+
+def stop_live_catheters():
+    """Remove the live observers; models keep their last geometry."""
+    for state in _liveCatheters.values():
+        for tag in state["observers"]:
+            state["markups"].RemoveObserver(tag)
+        # Freeze the current output so the model no longer depends on the pipeline
+        output = vtk.vtkPolyData()
+        state["tube"].Update()
+        output.DeepCopy(state["tube"].GetOutput())
+        state["model"].SetAndObservePolyData(output)
+    if _liveCatheters:
+        print(f"[OK] Live update stopped for {len(_liveCatheters)} catheter models.")
+    _liveCatheters.clear()
+    _pendingLiveUpdates.clear()
+
+def _closest_on_segments(points, a, b):
+    """Closest points and distances from points[i] to segments a[i]-b[i] (all Nx3)."""
+    ab = b - a
+    t = np.einsum('ij,ij->i', points - a, ab) / np.maximum(np.einsum('ij,ij->i', ab, ab), 1e-12)
+    closest = a + np.clip(t, 0.0, 1.0)[:, None] * ab
+    return closest, np.linalg.norm(points - closest, axis=1)
+
+class CatheterLocator:
+    """
+    Spatial queries against the resampled catheter paths (same 0.5 mm spline as the models).
+
+    Each catheter keeps its own KD-tree over the path samples (scipy.spatial.cKDTree, or a
+    chunked NumPy search without scipy). Point add/move/remove events only mark that catheter
+    dirty; its path and tree are rebuilt on the next query. Distances are to the polyline:
+    the nearest sample is refined against its two adjacent segments.
+
+    Usage:
+        locator = CatheterLocator(catheters)          # (catheter_id, markupsNode) pairs
+        ids, dist, closest = locator.nearest(points)  # points: Px3 RAS
+        D = locator.distances(points)                 # P x C, columns in locator.ids order
+        hits = locator.within(points, 5.0)            # catheter IDs within 5 mm, per point
+        ids = locator.near_structure(slicer.util.arrayFromModelPoints(model), 5.0)
+        locator.close()
+    """
+
+    CHUNK = 2048
+
+    def __init__(self, catheters, spacing_mm=0.5):
+        self.spacing_mm = spacing_mm
+        self._nodes = {}
+        self._paths = {}
+        self._trees = {}
+        self._observers = {}
+        self._dirty = set()
+        for catheter_id, markupsNode in catheters:
+            self.add(catheter_id, markupsNode)
+
+    @property
+    def ids(self):
+        self._refresh()
+        return sorted(self._paths)
+
+    def add(self, catheter_id, markupsNode):
+        """Track a catheter; replaces an existing one with the same ID."""
+        self.remove(catheter_id)
+        self._nodes[catheter_id] = markupsNode
+        self._observers[catheter_id] = [markupsNode.AddObserver(e, lambda caller, event, cid=catheter_id: self._dirty.add(cid))
+                                        for e in LIVE_EVENTS]
+        self._dirty.add(catheter_id)
+
+    def remove(self, catheter_id):
+        markupsNode = self._nodes.pop(catheter_id, None)
+        for tag in self._observers.pop(catheter_id, []):
+            markupsNode.RemoveObserver(tag)
+        self._paths.pop(catheter_id, None)
+        self._trees.pop(catheter_id, None)
+        self._dirty.discard(catheter_id)
+
+    def close(self):
+        """Remove all observers."""
+        for catheter_id in list(self._nodes):
+            self.remove(catheter_id)
+
+    def _refresh(self):
+        for catheter_id in list(self._dirty):
+            markupsNode = self._nodes[catheter_id]
+            self._paths.pop(catheter_id, None)
+            self._trees.pop(catheter_id, None)
+            if markupsNode.GetNumberOfControlPoints() >= 2:
+                path = CatheterGeometry.spline_resample(
+                    CatheterGeometry.polyline_from_points(markups_points(markupsNode)), self.spacing_mm)
+                pts = numpy_support.vtk_to_numpy(path.GetPoints().GetData()).astype(float)
+                self._paths[catheter_id] = pts
+                self._trees[catheter_id] = cKDTree(pts) if cKDTree is not None else None
+        self._dirty.clear()
+
+    def _nearest_sample(self, catheter_id, points):
+        tree = self._trees[catheter_id]
+        if tree is not None:
+            return tree.query(points)[1]
+        pts = self._paths[catheter_id]
+        idx = np.empty(len(points), dtype=int)
+        for start in range(0, len(points), self.CHUNK):
+            chunk = points[start:start + self.CHUNK]
+            d2 = ((chunk[:, None, :] - pts[None, :, :]) ** 2).sum(axis=2)
+            idx[start:start + self.CHUNK] = d2.argmin(axis=1)
+        return idx
+
+    def _closest(self, catheter_id, points):
+        """Closest path points and distances for one catheter."""
+        pts = self._paths[catheter_id]
+        if len(pts) < 2:
+            closest = np.repeat(pts[:1], len(points), axis=0)
+            return closest, np.linalg.norm(points - closest, axis=1)
+        j = self._nearest_sample(catheter_id, points)
+        prev_c, prev_d = _closest_on_segments(points, pts[np.maximum(j - 1, 0)], pts[j])
+        next_c, next_d = _closest_on_segments(points, pts[j], pts[np.minimum(j + 1, len(pts) - 1)])
+        use_next = next_d < prev_d
+        return np.where(use_next[:, None], next_c, prev_c), np.where(use_next, next_d, prev_d)
+
+    def distances(self, points):
+        """P x C distances (mm) from each point to each catheter, columns in 'ids' order."""
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        ids = self.ids
+        D = np.empty((len(points), len(ids)))
+        for col, catheter_id in enumerate(ids):
+            D[:, col] = self._closest(catheter_id, points)[1]
+        return D
+
+    def nearest(self, points):
+        """
+        Nearest catheter per point.
+
+        Returns:
+            (ndarray, ndarray, ndarray): Catheter IDs (P), distances in mm (P) and closest
+            points on those catheters (Px3).
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        ids = self.ids
+        if not ids:
+            raise ValueError("No catheters with at least 2 points.")
+        best_d = np.full(len(points), np.inf)
+        best_id = np.zeros(len(points), dtype=int)
+        best_c = np.zeros_like(points)
+        for catheter_id in ids:
+            closest, d = self._closest(catheter_id, points)
+            better = d < best_d
+            best_d[better] = d[better]
+            best_id[better] = catheter_id
+            best_c[better] = closest[better]
+        return best_id, best_d, best_c
+
+    def within(self, points, radius_mm):
+        """Per point, the array of catheter IDs within radius_mm."""
+        ids = np.asarray(self.ids, dtype=int)
+        mask = self.distances(points) <= radius_mm
+        return [ids[row] for row in mask]
+
+    def near_structure(self, points, radius_mm):
+        """Catheter IDs passing within radius_mm of any of the points (e.g. a structure's surface)."""
+        ids = np.asarray(self.ids, dtype=int)
+        return ids[(self.distances(points) <= radius_mm).any(axis=0)]
+
+def report_lod(catheters, radius_mm=0.6, repeats=20):
+    """
+    Print triangle counts and 3D render time for the fixed sampling and every LOD level.
+
+    Each configuration is built as a temporary merged model, rendered 'repeats' times in the
+    first 3D view with every other model hidden, then removed. Returns None if there is no
+    3D view or no catheter with at least 2 points.
+    """
+    layoutManager = slicer.app.layoutManager()
+    threeDWidget = layoutManager.threeDWidget(0) if layoutManager else None
+    if threeDWidget is None:
+        print("[WARN] LOD report needs a 3D view; none is shown in the current layout.")
+        return None
+    view = threeDWidget.threeDView()
+
+    # Hide the other models so only the configuration under test is rendered
+    hidden = []
+    for modelNode in slicer.util.getNodesByClass('vtkMRMLModelNode'):
+        d = modelNode.GetDisplayNode()
+        if d and d.GetVisibility():
+            d.SetVisibility(False)
+            hidden.append(d)
+
+    print(f"\n=== Catheter LOD report ({len(catheters)} catheters) ===")
+    rows = []
+    try:
+        for lod in [None] + list(CatheterGeometry.LOD_LEVELS):
+            polys = [build_tube_polydata(m, radius_mm=radius_mm, lod=lod) for _, m in catheters]
+            triangles = sum(count_triangles(p) for p in polys if p is not None)
+
+            modelNode = build_merged_catheter_model(catheters, f"_lod_report_{lod}", radius_mm=radius_mm, lod=lod)
+            if modelNode is None:
+                print("[WARN] LOD report: no catheters with at least 2 points.")
+                return None
+            view.forceRender()
+            t0 = time.perf_counter()
+            for _ in range(repeats):
+                view.forceRender()
+            render_ms = 1000.0 * (time.perf_counter() - t0) / repeats
+            colorNode = modelNode.GetDisplayNode().GetColorNode()
+            slicer.mrmlScene.RemoveNode(modelNode)
+            slicer.mrmlScene.RemoveNode(colorNode)
+
+            label = lod or "fixed 0.5 mm"
+            rows.append({"lod": label, "triangles": triangles, "render_ms": render_ms})
+            print(f"  {label:>12s}: {triangles:8d} triangles, {render_ms:6.2f} ms/render")
+    finally:
+        for d in hidden:
+            d.SetVisibility(True)
+    return rows
+
+def main(N, prefix='C', radius_mm=0.6, merged=False, lod=None, lod_views=None, lod_report=False, live=False, locator=False):
+    """Find Markups nodes named C1..CN and create tube models named C1_model..CN_model
+    (or a single C_model with all catheters if merged is True).
+
+    lod picks a CatheterGeometry.LOD_LEVELS level for every view; lod_views maps levels to view node IDs
+    (e.g. {'high': ['vtkMRMLViewNode1'], 'low': ['vtkMRMLSliceNodeRed']}) and creates one
+    model per level, shown only in its views (suffix _<level>).
+    lod_report prints triangle counts and render times per level instead of creating models.
+    live keeps the per-catheter models updated while control points are edited (fixed
+    sampling; merged/lod/lod_views are ignored with a warning).
+    locator returns a CatheterLocator over the catheters instead of creating models."""
+    catheters = []
     for i in range(1, int(N) + 1):
         name = f"{str(prefix)}{i}"
         try:
@@ -82,9 +521,37 @@ def main(N, prefix='C', radius_mm=0.6):
         except Exception:
             print(f"[WARN] Markups node '{name}' not found. Skipping.")
             continue
+        catheters.append((i, markupsNode))
+
+    if lod_report:
+        return report_lod(catheters, radius_mm=radius_mm)
 
-        modelName = f"{name}_model"
-        build_tube_model_from_fiducials(markupsNode, modelName, radius_mm=radius_mm)
+    if live:
+        if merged or lod or lod_views:
+            print("[WARN] Live mode updates one model per catheter at the fixed 0.5 mm sampling; "
+                  "ignoring 'merged', 'lod' and 'lodViews'.")
+        return start_live_catheters(catheters, radius_mm=radius_mm)
+
+    if locator:
+        catheter_locator = CatheterLocator(catheters)
+        print(f"[OK] Catheter locator built over {len(catheter_locator.ids)} catheters.")
+        return catheter_locator
+
+    # (suffix, level, views) per model to create
+    variants = [("", lod, None)]
+    if lod_views:
+        variants = [(f"_{level}", level, views) for level, views in lod_views.items()]
+
+    for suffix, level, views in variants:
+        if merged:
+            build_merged_catheter_model(catheters, f"{prefix}_model{suffix}", radius_mm=radius_mm,
+                                        lod=level, view_node_ids=views)
+            continue
+        for i, markupsNode in catheters:
+            modelName = f"{markupsNode.GetName()}_model{suffix}"
+            build_tube_model_from_fiducials(markupsNode, modelName, radius_mm=radius_mm,
+                                            color=catheter_model_color(markupsNode, i),
+                                            lod=level, view_node_ids=views)
 
 
 # Check if 'N', 'prefix' and 'radius_mm' is defined in the global namespace
@@ -103,10 +570,51 @@ try:
 except NameError:
     radius_mm = 0.6
 
+try:
+    merged
+except NameError:
+    merged = False
+
+try:
+    lod
+except NameError:
+    lod = None
+
+try:
+    lodViews
+except NameError:
+    lodViews = None
+
+try:
+    lodReport
+except NameError:
+    lodReport = False
+
+try:
+    live
+except NameError:
+    live = False
+
+try:
+    locator
+except NameError:
+    locator = False
+
+# Locator from a previous exec() with the same script_globals (its observers are removed on rebuild)
+try:
+    catheterLocator
+except NameError:
+    catheterLocator = None
+
 if N is None:
     # Handle the case where inputs are not provided
     print("Error: Missing one input.")
     print("Please define 'N' before executing the script.")
 else:
     # Call the main function with the inputs
-    main(N, prefix, radius_mm)
+    if locator:
+        if catheterLocator is not None:
+            catheterLocator.close()
+        catheterLocator = main(N, prefix, radius_mm, locator=True)
+    else:
+        main(N, prefix, radius_mm, merged, lod, lodViews, lodReport, live)
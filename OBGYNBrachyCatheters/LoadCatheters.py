@@ -7,6 +7,8 @@ filePath = "/home/mariana/SlicerScripts/OBGYNBrachyCatheters/LoadCatheters.py"
 # Define the variable to pass
 script_globals = {'start':1, 'N': 28, 'folder': '/home/mariana/SlicerScenes/2024-11-11_GynBrachyteraphy/catheter_csv'}
 script_globals = {'start':3, 'N': 1, 'folder': '/home/mariana/Experiments/2025-08-21_Pig2/trajectories_csv', 'fileName':'R'}
+# CatheterGeometry.py is imported from filePath's folder; without filePath, pass this script's path
+# script_globals['scriptPath'] = '/path/to/OBGYNBrachyCatheters/LoadCatheters.py'
 
 # Execute the script with the provided globals
 exec(open(filePath, encoding='utf-8').read(), script_globals)
@@ -14,112 +16,117 @@ exec(open(filePath, encoding='utf-8').read(), script_globals)
 """
 
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 import slicer
-import vtk
-import numpy as np
 
-def import_catheters(start, N, folder, fileName):
-
-    required_cols = ['label', 'r', 'a', 's']  # defined/selected/visible/locked are optional; we set them to 1 anyway
-    
-    for i in range(start, N + start):
-        base = str(fileName) + str(i)
-        csv_path = os.path.join(folder, f"{base}.csv")
-        if not os.path.isfile(csv_path):
-            print(f"[WARN] File not found: {csv_path} — skipping.")
-            continue
-
-        # Load CSV as a Table node
-        try:
-            tableNode = slicer.util.loadTable(csv_path)
-        except Exception as e:
-            print(f"[ERROR] Could not load {csv_path}: {e}")
-            continue
-
-        table = tableNode.GetTable()
-
-        # Check required columns
-        col_map = {}
-        ok = True
-        for name in required_cols:
-            col = table.GetColumnByName(name)
-            if col is None:
-                print(f"[ERROR] {base}: Missing required column '{name}' in {csv_path}")
-                ok = False
-            else:
-                col_map[name] = col
-        if not ok:
-            slicer.mrmlScene.RemoveNode(tableNode)
-            continue
-
-        nrows = table.GetNumberOfRows()
-        if nrows == 0:
-            print(f"[INFO] {base}: No rows in table, nothing to import.")
-            slicer.mrmlScene.RemoveNode(tableNode)
-            continue
-
-        # Create or reuse Markups point list node named Ci
-        markupsName = base
-        try:
-            markupsNode = slicer.util.getNode(markupsName)
-            if markupsNode.GetClassName() != 'vtkMRMLMarkupsFiducialNode':
-                markupsNode = None
-        except Exception:
+# CatheterGeometry.py (next to this script) holds the shared Slicer-free catheter code. exec()
+# gives the script no __file__, so its folder comes from the 'scriptPath' global or, as in the
+# usage snippet, the 'filePath' defined in the Python console
+try:
+    import CatheterGeometry
+except ImportError:
+    import __main__
+    _scriptFile = globals().get("scriptPath") or getattr(__main__, "filePath", None)
+    if not _scriptFile:
+        raise ImportError("CatheterGeometry.py not found: define 'filePath' (the script path) in the console "
+                          "or pass 'scriptPath' in script_globals.")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(_scriptFile)))
+    import CatheterGeometry
+
+def update_catheter_node(markupsName, points, labels):
+    """Create or reuse the Markups point list 'markupsName' and set its points, labels and flags."""
+    try:
+        markupsNode = slicer.util.getNode(markupsName)
+        if markupsNode.GetClassName() != 'vtkMRMLMarkupsFiducialNode':
             markupsNode = None
-
-        if markupsNode is None:
-            markupsNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', markupsName)
-        else:
+    except Exception:
+        markupsNode = None
+
+    if markupsNode is None:
+        markupsNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', markupsName)
+
+    # Ensure display node exists and is visible
+    if not markupsNode.GetDisplayNode():
+        markupsNode.CreateDefaultDisplayNodes()
+    displayNode = markupsNode.GetDisplayNode()
+    # 3D view visibility
+    displayNode.SetVisibility(True)
+    # 2D slice visibility
+    displayNode.SetVisibility2D(True)
+    # Style
+    displayNode.SetTextScale(0)   # hide text labels
+    displayNode.SetGlyphScale(1)  # small glyphs
+
+    # Set all points at once, then labels and flags, inside one modify block
+    wasModifying = markupsNode.StartModify()
+    try:
+        # A different point count means a different catheter file: start from fresh points so
+        # no per-point state (status, associated node, orientation) carries over
+        if markupsNode.GetNumberOfControlPoints() != len(points):
             markupsNode.RemoveAllControlPoints()
-
-        # Ensure display node exists and is visible
-        if not markupsNode.GetDisplayNode():
-            markupsNode.CreateDefaultDisplayNodes()
-        displayNode = markupsNode.GetDisplayNode()
-        # 3D view visibility
-        displayNode.SetVisibility(True)
-        # 2D slice visibility
-        displayNode.SetVisibility2D(True)
-        # Style
-        displayNode.SetTextScale(0)   # hide text labels
-        displayNode.SetGlyphScale(1)  # small glyphs
-
-        # Add points
-        rCol, aCol, sCol = col_map['r'], col_map['a'], col_map['s']
-        lblCol = col_map['label']
-
-        for row in range(nrows):
-            try:
-                r = float(rCol.GetValue(row))
-                a = float(aCol.GetValue(row))
-                s = float(sCol.GetValue(row))
-            except Exception:
-                # If the arrays are string-typed, fall back to converting via vtkVariant
-                r = float(rCol.GetVariantValue(row).ToDouble())
-                a = float(aCol.GetVariantValue(row).ToDouble())
-                s = float(sCol.GetVariantValue(row).ToDouble())
-
-            lbl = lblCol.GetValue(row) if hasattr(lblCol, 'GetValue') else lblCol.GetVariantValue(row).ToString()
-            if lbl is None or str(lbl).strip() == '':
-                lbl = f"{base}_{row+1}"
-            else:
-                lbl = str(lbl)
-
-            idx = markupsNode.AddControlPoint(vtk.vtkVector3d(r, a, s))
+        # Setting positions also marks every point as defined
+        slicer.util.updateMarkupsControlPointsFromArray(markupsNode, points)
+        for idx, lbl in enumerate(labels):
             markupsNode.SetNthControlPointLabel(idx, lbl)
+            markupsNode.SetNthControlPointDescription(idx, "")
             # Set flags: defined/selected/visible/locked = 1
             markupsNode.SetNthControlPointSelected(idx, True)
             markupsNode.SetNthControlPointVisibility(idx, True)
             markupsNode.SetNthControlPointLocked(idx, True)
+    finally:
+        markupsNode.EndModify(wasModifying)
+    return markupsNode
+
+def import_catheters(start, N, folder, fileName, workers=8):
+    t_start = time.perf_counter()
 
-        # Done with table -> remove it
-        slicer.mrmlScene.RemoveNode(tableNode)
-        print(f"[OK] Imported {nrows} points into Markups node '{markupsName}' and deleted table.")
+    def load(base):
+        t0 = time.perf_counter()
+        csv_path = os.path.join(folder, f"{base}.csv")
+        if not os.path.isfile(csv_path):
+            return base, None, f"File not found: {csv_path}", 0.0
+        try:
+            points, labels = CatheterGeometry.read_catheter_csv(csv_path, base)
+        except Exception as e:
+            return base, None, f"Could not load {csv_path}: {e}", 0.0
+        return base, (points, labels), None, time.perf_counter() - t0
+
+    # Parse all files in parallel (no scene access here)
+    bases = [str(fileName) + str(i) for i in range(start, N + start)]
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+        parsed = list(pool.map(load, bases))
+    t_parsed = time.perf_counter()
+
+    # Create/update all Markups nodes in one scene batch, rendering once at the end
+    imported = 0
+    slicer.app.pauseRender()
+    slicer.mrmlScene.StartState(slicer.vtkMRMLScene.BatchProcessState)
+    try:
+        for base, data, error, t_file in parsed:
+            if error:
+                print(f"[WARN] {base}: {error} — skipping.")
+                continue
+            points, labels = data
+            if not labels:
+                print(f"[INFO] {base}: No rows in table, nothing to import.")
+                continue
+            update_catheter_node(base, points, labels)
+            imported += 1
+            print(f"[OK] Imported {len(labels)} points into Markups node '{base}' (parsed in {1000*t_file:.1f} ms).")
+    finally:
+        slicer.mrmlScene.EndState(slicer.vtkMRMLScene.BatchProcessState)
+        slicer.app.resumeRender()
+    t_end = time.perf_counter()
+
+    print(f"[TIME] {imported}/{len(bases)} catheters: parse {1000*(t_parsed - t_start):.1f} ms, "
+          f"scene update {1000*(t_end - t_parsed):.1f} ms, total {1000*(t_end - t_start):.1f} ms.")
 
 
 def main(start, N, folder, fileName):
-    #  Load fileNamei.csv for i in [1..N], create/update Markups nodes named Ci with points
-    # from the CSV table, then remove the temporary table nodes.
+    #  Load fileNamei.csv for i in [1..N] and create/update Markups nodes named Ci with points
+    # from the CSV file.
     print(f"Loading total of {N} catheters with input name '{fileName}'.")    
     import_catheters(start, N, folder, fileName)
     print("[DONE] Import finished.")
@@ -6,11 +6,38 @@ filePath = "/home/mariana/SlicerScripts/ScalarVolumes/CompareBias.py"
 # Define the variable to pass
 script_globals = {'volumeA': '71-72 COR M', 'volumeB': '71-72 SAG M', 'maskA': 'Mask', 'maskB': 'Mask'}
 script_globals = {'volumeA': '82-83 COR M', 'volumeB': '82-83 SAG M', 'maskA': 'Mask', 'maskB': 'Mask'}
-
-# Execute the script with the provided globals
+# Optional: fit the per-slice N4 of both volumes in 8 worker processes
+script_globals = {'volumeA': '82-83 COR M', 'volumeB': '82-83 SAG M', 'maskA': 'Mask', 'maskB': 'Mask', 'numWorkers': 8}
+# Log-bias fields are cached on disk (keyed on voxels, mask and N4 parameters); set 'cacheDir' to
+# choose the folder, or None to disable the cache
+script_globals = {'volumeA': '82-83 COR M', 'volumeB': '82-83 SAG M', 'maskA': 'Mask', 'maskB': 'Mask', 'cacheDir': '/home/mariana/N4Cache'}
+
+# Batch: evaluate a study table in one run and write one row per pair and plane (CSV or JSON)
+script_globals = {'pairs': [('71-72 COR M', '71-72 SAG M', 'Mask', 'Mask'),
+                            ('82-83 COR M', '82-83 SAG M', 'Mask', 'Mask')],
+                  'resultsPath': '/home/mariana/N4Bias_results.csv', 'numWorkers': 8}
+
+# Adaptive N4 (shrink/control points from slice size, early stop): add 'n4Adaptive': True.
+# Benchmark adaptive vs fixed N4 (runtime and agreement) on one volume:
+script_globals = {'benchmarkVolume': '71-72 COR M', 'maskA': 'Mask', 'numWorkers': 8}
+# Check that the worker pool reproduces the serial N4 fields exactly on one volume:
+script_globals = {'parityVolume': '71-72 COR M', 'maskA': 'Mask', 'numWorkers': 8}
+
+# Execute the script with the provided globals (with numWorkers > 1, scriptPath locates N4Slice.py)
+script_globals['scriptPath'] = filePath
 exec(open(filePath, encoding='utf-8').read(), script_globals)
 """
 
+import os
+import re
+import time
+import csv
+import json
+import hashlib
+import sys
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
 import SimpleITK as sitk
 from math import exp
@@ -51,37 +78,85 @@ def to_sitk_mask_like(slice_img, slice_mask=None):
     m = sitk.BinaryThreshold(m, 1, 255, 1, 0)
     return m
 
+# Rasterized masks per (segmentation state, reference geometry); kept across exec() calls
+# that reuse the same script_globals
+try:
+    _maskCache
+except NameError:
+    _maskCache = {}
+
+def _mask_cache_key(segNode, refNode, segment_ids):
+    seg = segNode.GetSegmentation()
+    master = seg.GetSourceRepresentationName() if hasattr(seg, "GetSourceRepresentationName") else seg.GetMasterRepresentationName()
+    seg_state = [seg.GetMTime()]
+    for sid in segment_ids:
+        rep = seg.GetSegment(sid).GetRepresentation(master)
+        seg_state.append((sid, rep.GetMTime() if rep else 0))
+
+    ijk_to_ras = vtk.vtkMatrix4x4()
+    refNode.GetIJKToRASMatrix(ijk_to_ras)
+    seg_to_ref = vtk.vtkMatrix4x4()
+    slicer.vtkMRMLTransformNode.GetMatrixTransformBetweenNodes(
+        segNode.GetParentTransformNode(), refNode.GetParentTransformNode(), seg_to_ref)
+    geometry = (refNode.GetImageData().GetDimensions(),
+                tuple(ijk_to_ras.GetElement(r, c) for r in range(4) for c in range(4)),
+                tuple(seg_to_ref.GetElement(r, c) for r in range(4) for c in range(4)))
+    return (segNode.GetID(), tuple(seg_state), geometry)
+
 def seg_to_mask_for_reference(seg_node_name, ref_volume_name, segment_names=None, out_label_name=None):
+    """
+    Rasterize a segmentation on the reference volume grid as a binary SimpleITK mask.
+
+    Transforms are not hardened: the temporary labelmap is placed under the reference's parent
+    transform and the export resolves the segmentation-to-reference transform. The labelmap
+    node is removed after the pull and the mask cached per segmentation state and reference
+    geometry, so repeated calls (e.g. maskA == maskB on the same grid) rasterize once.
+
+    Returns:
+        (sitk.Image, None): The mask; the second item is kept for compatibility (no node is left).
+    """
     segNode = slicer.util.getNode(seg_node_name)
     refNode = slicer.util.getNode(ref_volume_name)
 
-    tl = slicer.vtkSlicerTransformLogic()
-    if segNode.GetParentTransformNode():
-        tl.hardenTransform(segNode)
-    if refNode.GetParentTransformNode():
-        tl.hardenTransform(refNode)
+    seg = segNode.GetSegmentation()
+    if segment_names is None:
+        segment_ids = vtk.vtkStringArray()
+        if segNode.GetDisplayNode():
+            segNode.GetDisplayNode().GetVisibleSegmentIDs(segment_ids)
+        else:
+            seg.GetSegmentIDs(segment_ids)
+        segment_ids = [segment_ids.GetValue(i) for i in range(segment_ids.GetNumberOfValues())]
+    else:
+        segment_ids = []
+        for nm in segment_names:
+            sid = seg.GetSegmentIdBySegmentName(nm)
+            if not sid:
+                raise ValueError(f"Segment name not found: {nm}")
+            segment_ids.append(sid)
+
+    key = _mask_cache_key(segNode, refNode, segment_ids)
+    if key in _maskCache:
+        return _maskCache[key], None
 
     if out_label_name is None:
         out_label_name = f"{seg_node_name}_asMask_{ref_volume_name}"
     labelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", out_label_name)
+    try:
+        labelNode.SetAndObserveTransformNodeID(refNode.GetTransformNodeID())
 
-    logic = slicer.vtkSlicerSegmentationsModuleLogic()
-
-    if segment_names is None:
-        logic.ExportVisibleSegmentsToLabelmapNode(segNode, labelNode, refNode)
-    else:
         ids = vtk.vtkStringArray()
-        seg = segNode.GetSegmentation()
-        for nm in segment_names:
-            sid = seg.GetSegmentIdBySegmentName(nm)
-            if sid is None:
-                raise ValueError(f"Segment name not found: {nm}")
+        for sid in segment_ids:
             ids.InsertNextValue(sid)
+        logic = slicer.vtkSlicerSegmentationsModuleLogic()
         logic.ExportSegmentsToLabelmapNode(segNode, ids, labelNode, refNode)
 
-    mask_sitk = sitkUtils.PullVolumeFromSlicer(labelNode)
+        mask_sitk = sitkUtils.PullVolumeFromSlicer(labelNode)
+    finally:
+        slicer.mrmlScene.RemoveNode(labelNode)
+
     mask_sitk = sitk.BinaryThreshold(sitk.Cast(mask_sitk, sitk.sitkUInt8), 1, 255, 1, 0)
-    return mask_sitk, labelNode
+    _maskCache[key] = mask_sitk
+    return mask_sitk, None
 
 def extract_slice_2d(img3d, k):
     size = list(img3d.GetSize())
@@ -114,20 +189,71 @@ def per_slice_mask(img3d, mask3d=None):
         masks.append(to_sitk_mask_like(s2d, m2d))
     return masks
 
-def n4_slice_bias(slice_img, slice_mask, shrink_factor=2, conv=[50,50,30,20], bspline_mm=50.0, fitting_levels=4):
+def adaptive_n4_config(slice_img, bspline_mm=50.0, conv=[50,50,30,20], fitting_levels=4,
+                       target_mm=4.0, min_px=32):
+    """
+    Pick shrink factor, control-point grid and fitting levels from slice size and spacing.
+
+    The shrink brings pixels to ~target_mm while keeping at least min_px pixels per side;
+    levels are dropped while the finest B-spline mesh would exceed half the shrunk pixels.
+    """
+    size = slice_img.GetSize()
+    spacing = slice_img.GetSpacing()
+    shrink = int(round(target_mm / min(spacing[0], spacing[1])))
+    shrink = max(1, min(shrink, min(size[0], size[1]) // min_px))
+
+    extent_mm = (size[0]*spacing[0], size[1]*spacing[1])
+    nx = max(4, int(round(extent_mm[0]/bspline_mm)))
+    ny = max(4, int(round(extent_mm[1]/bspline_mm)))
+
+    shrunk_px = min(size[0], size[1]) // shrink
+    levels = int(fitting_levels)
+    while levels > 1 and (max(nx, ny) - 3) * 2**(levels - 1) + 3 > shrunk_px // 2:
+        levels -= 1
+    return {"shrink_factor": shrink, "control_points": [nx, ny],
+            "fitting_levels": levels, "conv": list(conv[:levels])}
+
+def n4_slice_bias(slice_img, slice_mask, shrink_factor=2, conv=[50,50,30,20], bspline_mm=50.0, fitting_levels=4,
+                  adaptive=False, tol=1e-4, threads=1, record=None):
+    """
+    N4 log-bias of one 2D slice.
+
+    adaptive=True derives shrink factor, control points and levels from the slice (adaptive_n4_config)
+    and stops each level once N4's change in the bias estimate drops below 'tol' instead of 1e-7.
+    threads pins the N4 filter's ITK threads: its B-spline fit accumulates per-thread lattices,
+    so the result can depend on the thread count.
+    If 'record' is a dict, it receives the configuration and the iterations actually run per level.
+    """
+    control_points = None
+    convergence = 1e-7
+    if adaptive:
+        cfg = adaptive_n4_config(slice_img, bspline_mm=bspline_mm, conv=conv, fitting_levels=fitting_levels)
+        shrink_factor, conv, fitting_levels = cfg["shrink_factor"], cfg["conv"], cfg["fitting_levels"]
+        control_points = cfg["control_points"]
+        convergence = float(tol)
+
     corrector = sitk.N4BiasFieldCorrectionImageFilter()
     corrector.SetMaximumNumberOfIterations(conv)
-    corrector.SetConvergenceThreshold(1e-7)
+    corrector.SetConvergenceThreshold(convergence)
     corrector.SetSplineOrder(3)
+    corrector.SetNumberOfThreads(max(1, int(threads)))
     if hasattr(corrector, "SetNumberOfFittingLevels"):
         corrector.SetNumberOfFittingLevels(int(fitting_levels))
     if hasattr(corrector, "SetNumberOfControlPoints"):
-        size = slice_img.GetSize()
-        spacing = slice_img.GetSpacing()
-        extent_mm = (size[0]*spacing[0], size[1]*spacing[1])
-        nx = max(4, int(round(extent_mm[0]/bspline_mm)))
-        ny = max(4, int(round(extent_mm[1]/bspline_mm)))
-        corrector.SetNumberOfControlPoints([nx, ny])
+        if control_points is None:
+            size = slice_img.GetSize()
+            spacing = slice_img.GetSpacing()
+            extent_mm = (size[0]*spacing[0], size[1]*spacing[1])
+            nx = max(4, int(round(extent_mm[0]/bspline_mm)))
+            ny = max(4, int(round(extent_mm[1]/bspline_mm)))
+            control_points = [nx, ny]
+        corrector.SetNumberOfControlPoints(control_points)
+
+    iterations = [0] * int(fitting_levels)
+    if record is not None:
+        def count_iteration():
+            iterations[min(corrector.GetCurrentLevel(), len(iterations) - 1)] += 1
+        corrector.AddCommand(sitk.sitkIterationEvent, count_iteration)
 
     shrink = [max(1, int(shrink_factor)), max(1, int(shrink_factor))]
     sim   = sitk.Shrink(slice_img, shrink)
@@ -136,52 +262,274 @@ def n4_slice_bias(slice_img, slice_mask, shrink_factor=2, conv=[50,50,30,20], bs
 
     _ = corrector.Execute(sim, smask)
     log_bias = corrector.GetLogBiasFieldAsImage(slice_img)
-    return sitk.Cast(log_bias, sitk.sitkFloat32)
 
-def compute_biasfield_per_slice(img3d, mask3d=None, **n4kw):
-    depth = img3d.GetDepth()
-    masks2d = per_slice_mask(img3d, mask3d)
-    log_slices = []
-    for k in range(depth):
-        s2d = extract_slice_2d(img3d, k)
-        logb = n4_slice_bias(s2d, masks2d[k], **n4kw)
-        log_slices.append(logb)
-    return stack_slices_to_3d(log_slices, img3d)
+    if record is not None:
+        record.update(shrink_factor=int(shrink_factor), fitting_levels=int(fitting_levels),
+                      control_points=control_points, iterations=iterations)
+    return sitk.Cast(log_bias, sitk.sitkFloat32)
 
-def bias_stats_core(log_bias_3d, mask3d):
-    arr = sitk.GetArrayFromImage(log_bias_3d)  # z,y,x
-    msk = sitk.GetArrayFromImage(mask3d).astype(bool)
+def load_n4_module():
+    """
+    Import N4Slice.py (next to this script) for the worker pool.
+
+    exec() gives the script no __file__, so its folder comes from the 'scriptPath' global
+    when N4Slice is not already importable. Only needed with more than one worker.
+    """
+    try:
+        import N4Slice
+    except ImportError:
+        if not scriptPath:
+            raise ImportError("numWorkers > 1 runs N4 in worker processes that import N4Slice.py: "
+                              "add 'scriptPath': filePath to script_globals (or use numWorkers=1).")
+        module_dir = os.path.dirname(os.path.abspath(scriptPath))
+        if module_dir not in sys.path:
+            sys.path.insert(0, module_dir)
+        import N4Slice
+    return N4Slice
+
+def _spawn_context():
+    """Spawn context using Slicer's standalone Python (the Slicer executable cannot run workers)."""
+    ctx = mp.get_context("spawn")
+    bin_dir = os.path.dirname(sys.executable)
+    for name in ("PythonSlicer", "PythonSlicer.exe"):
+        candidate = os.path.join(bin_dir, name)
+        if os.path.isfile(candidate):
+            ctx.set_executable(candidate)
+            break
+    return ctx
+
+def run_n4_tasks(slices, workers, n4kw):
+    """
+    N4 log-bias for every (slice, mask) pair, returned as (array, record) in input order.
+
+    workers <= 1 runs n4_slice_bias in this process. Otherwise N4Slice.n4_slice_task runs in a
+    ProcessPoolExecutor on a fresh 'spawn' context (the running Slicer process, with Qt/OpenGL
+    and ITK thread pools, is never forked); a worker that crashes or is killed raises
+    RuntimeError instead of hanging. Both paths use n4kw['threads'] ITK threads per slice, so
+    they give the same fields (see check_worker_parity).
+    """
+    workers = min(int(workers or 1), len(slices))
+    if workers <= 1:
+        outputs = []
+        for s2d, m2d in slices:
+            record = {}
+            outputs.append((sitk.GetArrayFromImage(n4_slice_bias(s2d, m2d, record=record, **n4kw)), record))
+        return outputs
+
+    N4Slice = load_n4_module()
+    tasks = [N4Slice.slice_task(s2d, m2d, n4kw) for s2d, m2d in slices]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_spawn_context(),
+                             initializer=N4Slice.init_worker, initargs=(n4kw["threads"],)) as pool:
+        try:
+            return list(pool.map(N4Slice.n4_slice_task, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+        except BrokenProcessPool as e:
+            raise RuntimeError("An N4 worker process died (crash or out of memory); "
+                               "re-run with fewer 'numWorkers' or numWorkers=1.") from e
+
+# Defaults of n4_slice_bias, merged into cache keys so implicit and explicit parameters hash alike
+# (threads included: it is pinned identically in the serial and pool paths)
+N4_DEFAULTS = {"shrink_factor": 2, "conv": [50,50,30,20], "bspline_mm": 50.0, "fitting_levels": 4,
+               "adaptive": False, "tol": 1e-4, "threads": 1}
+N4_CACHE_VERSION = 2
+
+def _hash_image(h, im):
+    h.update(repr((im.GetSize(), im.GetSpacing(), im.GetOrigin(), im.GetDirection(),
+                   im.GetPixelIDTypeAsString())).encode())
+    h.update(sitk.GetArrayViewFromImage(im).tobytes())
+
+def biasfield_cache_path(cache_dir, img3d, mask3d, n4kw):
+    """Cache file for the per-slice log-bias of img3d, keyed on voxels, mask and N4 parameters."""
+    h = hashlib.sha1()
+    params = dict(N4_DEFAULTS, **n4kw)
+    h.update(json.dumps(dict(params, version=N4_CACHE_VERSION), sort_keys=True, default=str).encode())
+    _hash_image(h, img3d)
+    if mask3d is not None:
+        _hash_image(h, mask3d)
+    else:
+        h.update(b"otsu")
+    return os.path.join(cache_dir, f"logbias_{h.hexdigest()}.nrrd")
+
+def compute_biasfields_per_slice(volumes, workers=1, cache_dir=None, records=None, **n4kw):
+    """
+    Per-slice N4 log-bias for several (img3d, mask3d) pairs, with all slices of all
+    volumes dispatched together to 'workers' processes.
+
+    With cache_dir, fields are loaded from / stored to disk keyed on the voxel data,
+    the mask and the N4 parameters, and only cache misses are computed.
+    If 'records' is a list, it receives one list of per-slice N4 records (configuration and
+    iterations used) per volume, or None for volumes loaded from the cache.
+
+    Returns:
+        list: One stacked 3D log-bias image per input pair (identical to the serial result).
+    """
+    results = [None] * len(volumes)
+    cache_paths = [None] * len(volumes)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        for v, (img3d, mask3d) in enumerate(volumes):
+            cache_paths[v] = biasfield_cache_path(cache_dir, img3d, mask3d, n4kw)
+            if os.path.isfile(cache_paths[v]):
+                results[v] = sitk.ReadImage(cache_paths[v], sitk.sitkFloat32)
+                print(f"[CACHE] Loaded log-bias from {cache_paths[v]}")
+
+    n4kw = dict(n4kw, threads=n4kw.get("threads", N4_DEFAULTS["threads"]))
+    jobs, slices = [], []
+    for v, (img3d, mask3d) in enumerate(volumes):
+        if results[v] is not None:
+            continue
+        masks2d = per_slice_mask(img3d, mask3d)
+        for k in range(img3d.GetDepth()):
+            s2d = extract_slice_2d(img3d, k)
+            jobs.append((s2d, masks2d[k]))
+            slices.append((v, s2d))
+
+    outputs = run_n4_tasks(jobs, workers, n4kw) if jobs else []
+
+    log_slices = {}
+    slice_records = [None] * len(volumes)
+    for (v, s2d), (arr, record) in zip(slices, outputs):
+        logb = sitk.GetImageFromArray(arr)
+        logb.CopyInformation(s2d)
+        log_slices.setdefault(v, []).append(logb)
+        slice_records[v] = (slice_records[v] or []) + [record]
+    if records is not None:
+        records.extend(slice_records)
+
+    for v, ls in log_slices.items():
+        results[v] = stack_slices_to_3d(ls, volumes[v][0])
+        if cache_paths[v]:
+            # Write next to the cache file and rename, so an interrupted or concurrent run never
+            # leaves a truncated field under the final name
+            tmp_path = f"{os.path.splitext(cache_paths[v])[0]}.{os.getpid()}.tmp.nrrd"
+            try:
+                sitk.WriteImage(results[v], tmp_path, True)
+                os.replace(tmp_path, cache_paths[v])
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    return results
+
+def compute_biasfield_per_slice(img3d, mask3d=None, workers=1, cache_dir=None, **n4kw):
+    return compute_biasfields_per_slice([(img3d, mask3d)], workers=workers, cache_dir=cache_dir, **n4kw)[0]
+
+def benchmark_adaptive_n4(vol_name, mask_name=None, tolerances=(1e-3, 1e-4, 1e-5), workers=1):
+    """
+    Compare adaptive N4 against the fixed configuration on one volume (no cache).
+
+    Prints runtime, mean iterations per slice and agreement with the fixed log-bias inside
+    the ROI (max and RMS difference, in percent bias). Returns the rows as dicts.
+    """
+    img = get_sitk_image(vol_name)[0]
+    mask = seg_to_mask_for_reference(mask_name, vol_name)[0] if mask_name else volume_mask(img)
+    m = sitk.GetArrayViewFromImage(mask) != 0
+
+    def run(**kw):
+        records = []
+        t0 = time.perf_counter()
+        logb = compute_biasfields_per_slice([(img, mask)], workers=workers, records=records,
+                                            bspline_mm=50.0, shrink_factor=2, conv=[50,50,30,20], **kw)[0]
+        elapsed = time.perf_counter() - t0
+        iters = float(np.mean([sum(r["iterations"]) for r in records[0]]))
+        return logb, elapsed, iters
+
+    ref, ref_time, ref_iters = run()
+    ref_vals = sitk.GetArrayViewFromImage(ref)[m]
+    print(f"\n=== Adaptive N4 benchmark: {vol_name} ({img.GetDepth()} slices) ===")
+    print(f"  fixed     : {ref_time:6.2f} s, {ref_iters:6.1f} it/slice")
+
+    rows = [{"config": "fixed", "tol": None, "time_s": ref_time, "iters_per_slice": ref_iters,
+             "max_diff_pct": 0.0, "rms_diff_pct": 0.0}]
+    for tol in tolerances:
+        logb, elapsed, iters = run(adaptive=True, tol=tol)
+        diff = to_pct(sitk.GetArrayViewFromImage(logb)[m]) - to_pct(ref_vals)
+        max_d = float(np.max(np.abs(diff))) if diff.size else np.nan
+        rms_d = float(np.sqrt(np.mean(diff**2))) if diff.size else np.nan
+        print(f"  tol={tol:<7g}: {elapsed:6.2f} s, {iters:6.1f} it/slice, "
+              f"speed-up x{ref_time / max(elapsed, 1e-9):.1f}, max |diff| {max_d:.2f}%, RMS {rms_d:.2f}%")
+        rows.append({"config": "adaptive", "tol": tol, "time_s": elapsed, "iters_per_slice": iters,
+                     "max_diff_pct": max_d, "rms_diff_pct": rms_d})
+    return rows
+
+def check_worker_parity(vol_name, mask_name=None, workers=2, **n4kw):
+    """
+    Fit the per-slice N4 of one volume serially and in 'workers' processes (no cache) and
+    compare the log-bias fields voxel by voxel.
+
+    Returns:
+        float: Maximum absolute difference (0.0 means the pool reproduces the serial result).
+    """
+    img = get_sitk_image(vol_name)[0]
+    mask = seg_to_mask_for_reference(mask_name, vol_name)[0] if mask_name else volume_mask(img)
+    n4kw = dict(dict(bspline_mm=50.0, shrink_factor=2, conv=[50,50,30,20]), **n4kw)
+
+    serial = compute_biasfields_per_slice([(img, mask)], workers=1, **n4kw)[0]
+    pooled = compute_biasfields_per_slice([(img, mask)], workers=max(2, int(workers)), **n4kw)[0]
+    diff = np.abs(sitk.GetArrayViewFromImage(serial).astype(np.float64) -
+                  sitk.GetArrayViewFromImage(pooled).astype(np.float64))
+    max_diff = float(diff.max()) if diff.size else 0.0
+    status = "[OK] identical" if max_diff == 0.0 else f"[WARN] differ in {int(np.count_nonzero(diff))} voxels"
+    print(f"{status}: serial vs {max(2, int(workers))} workers on {vol_name}, max |diff| {max_diff:.3g} (log-bias).")
+    return max_diff
+
+def roi_statistics(logB, mask, thresholds=(0.1, 0.2)):
+    """
+    All ROI statistics of a log-bias field in one pass.
+
+    Both images are viewed zero-copy and the masked voxels gathered once (z-major, so each
+    slice is a contiguous run). Percentiles, MAD and threshold proportions come from one
+    sorted buffer; slice medians from the per-slice runs.
+
+    Returns:
+        dict: n, mad, iqr_half, pct_above {threshold: percent}, slice_medians (log),
+              slice_pct, slice_range_pct, slice_sd_pct.
+    """
+    arr = sitk.GetArrayViewFromImage(logB)  # z,y,x
+    msk = sitk.GetArrayViewFromImage(mask) != 0
     vals = arr[msk]
-    if vals.size == 0:
-        return {"n":0,"mad":np.nan,"iqr_half":np.nan}
-    q1, med, q3 = np.percentile(vals, [25,50,75])
-    mad = float(np.median(np.abs(vals - med)))
-    iqr_half = float((q3 - q1)/2.0)
-    return {"n": int(vals.size), "mad": mad, "iqr_half": iqr_half}
-
-def slice_medians(logB, mask):
-    arr = sitk.GetArrayFromImage(logB); m = sitk.GetArrayFromImage(mask).astype(bool)
-    meds = [float(np.median(arr[z][m[z]])) for z in range(arr.shape[0]) if m[z].any()]
-    return meds
-
-def slice_drift_percent(logB, mask):
-    to_pct = lambda x: 100.0*(np.exp(x)-1.0)
-    meds = slice_medians(logB, mask)
+    n = int(vals.size)
+
+    # Per-slice medians from the contiguous runs of each slice
+    counts = msk.reshape(msk.shape[0], -1).sum(axis=1)
+    bounds = np.concatenate(([0], np.cumsum(counts)))
+    meds = [float(np.median(vals[bounds[z]:bounds[z+1]])) for z in range(len(counts)) if counts[z]]
     meds_pct = [to_pct(x) for x in meds]
-    if not meds_pct:
-        return meds_pct, np.nan, np.nan
-    return meds_pct, float(max(meds_pct)-min(meds_pct)), float(np.std(meds_pct))
 
-def pct_above(th, logB, mask):
-    a = sitk.GetArrayFromImage(logB); m = sitk.GetArrayFromImage(mask).astype(bool)
-    v = np.abs(a[m]); 
-    return 100.0 * np.mean(v > th) if v.size else np.nan
+    stats = {
+        "n": n, "mad": np.nan, "iqr_half": np.nan,
+        "pct_above": {th: np.nan for th in thresholds},
+        "slice_medians": meds,
+        "slice_pct": meds_pct,
+        "slice_range_pct": float(max(meds_pct)-min(meds_pct)) if meds_pct else np.nan,
+        "slice_sd_pct": float(np.std(meds_pct)) if meds_pct else np.nan,
+    }
+    if n == 0:
+        return stats
+
+    vals.sort()
+    q1, med, q3 = np.percentile(vals, [25,50,75])
+    stats["mad"] = float(np.median(np.abs(vals - med)))
+    stats["iqr_half"] = float((q3 - q1)/2.0)
+    # |v| > th  <=>  v > th or v < -th, counted on the sorted buffer
+    for th in thresholds:
+        above = (n - np.searchsorted(vals, th, side="right")) + np.searchsorted(vals, -th, side="left")
+        stats["pct_above"][th] = 100.0 * above / n
+    return stats
 
 def to_pct(x):  # log -> percent
     return 100.0*(np.exp(x)-1.0)
 
+def volume_mask(im):
+    sm = sitk.CurvatureFlow(im, timeStep=0.01, numberOfIterations=3)
+    m = sitk.OtsuThreshold(sm, 0, 1)
+    return sitk.Cast(m, sitk.sitkUInt8)
+
+def plane_from_name(volume_name):
+    """'82-83 COR M' -> 'COR' (None if the name has no AX/COR/SAG token)."""
+    match = re.search(r"\b(AX|COR|SAG)\b", volume_name)
+    return match.group(1) if match else None
+
 # ----------------- Main -----------------
-def main (VOL_A_NAME, VOL_B_NAME, MASK_A_NAME, MASK_B_NAME, OUTPUT_PREFIX):
+def main (VOL_A_NAME, VOL_B_NAME, MASK_A_NAME, MASK_B_NAME, OUTPUT_PREFIX, NUM_WORKERS=1, CACHE_DIR=None, N4_ADAPTIVE=False):
     imgA_sitk, nodeA = get_sitk_image(VOL_A_NAME)
     imgB_sitk, nodeB = get_sitk_image(VOL_B_NAME)
 
@@ -192,21 +540,17 @@ def main (VOL_A_NAME, VOL_B_NAME, MASK_A_NAME, MASK_B_NAME, OUTPUT_PREFIX):
     if MASK_B_NAME:
         maskB_sitk, _ = seg_to_mask_for_reference(MASK_B_NAME, VOL_B_NAME)
 
-    def volume_mask(im):
-        sm = sitk.CurvatureFlow(im, timeStep=0.01, numberOfIterations=3)
-        m = sitk.OtsuThreshold(sm, 0, 1)
-        return sitk.Cast(m, sitk.sitkUInt8)
-
     if maskA_sitk is None: maskA_sitk = volume_mask(imgA_sitk)
     if maskB_sitk is None: maskB_sitk = volume_mask(imgB_sitk)
 
-    # Compute N4 log-bias fields (per-slice)
-    logB_A = compute_biasfield_per_slice(imgA_sitk, maskA_sitk, bspline_mm=50.0, shrink_factor=2, conv=[50,50,30,20])
-    logB_B = compute_biasfield_per_slice(imgB_sitk, maskB_sitk, bspline_mm=50.0, shrink_factor=2, conv=[50,50,30,20])
+    # Compute N4 log-bias fields (per-slice, both volumes in one worker pool)
+    logB_A, logB_B = compute_biasfields_per_slice([(imgA_sitk, maskA_sitk), (imgB_sitk, maskB_sitk)],
+                                                  workers=NUM_WORKERS, cache_dir=CACHE_DIR, adaptive=N4_ADAPTIVE,
+                                                  bspline_mm=50.0, shrink_factor=2, conv=[50,50,30,20])
 
-    # --- Core stats only ---
-    statsA = bias_stats_core(logB_A, maskA_sitk)
-    statsB = bias_stats_core(logB_B, maskB_sitk)
+    # --- Core stats only (one pass per volume) ---
+    statsA = roi_statistics(logB_A, maskA_sitk, thresholds=(0.1, 0.2))
+    statsB = roi_statistics(logB_B, maskB_sitk, thresholds=(0.1, 0.2))
 
     # convert dispersion to percent
     A_MAD_pct = to_pct(statsA["mad"])
@@ -215,12 +559,12 @@ def main (VOL_A_NAME, VOL_B_NAME, MASK_A_NAME, MASK_B_NAME, OUTPUT_PREFIX):
     B_IQRhalf_pct = to_pct(statsB["iqr_half"])
 
     # proportions above thresholds
-    A_p10 = pct_above(0.1, logB_A, maskA_sitk); B_p10 = pct_above(0.1, logB_B, maskB_sitk)
-    A_p22 = pct_above(0.2, logB_A, maskA_sitk); B_p22 = pct_above(0.2, logB_B, maskB_sitk)
+    A_p10 = statsA["pct_above"][0.1]; B_p10 = statsB["pct_above"][0.1]
+    A_p22 = statsA["pct_above"][0.2]; B_p22 = statsB["pct_above"][0.2]
 
     # slice-wise drift (percent)
-    A_slice_pct, A_range_pct, A_sd_pct = slice_drift_percent(logB_A, maskA_sitk)
-    B_slice_pct, B_range_pct, B_sd_pct = slice_drift_percent(logB_B, maskB_sitk)
+    A_slice_pct, A_range_pct, A_sd_pct = statsA["slice_pct"], statsA["slice_range_pct"], statsA["slice_sd_pct"]
+    B_slice_pct, B_range_pct, B_sd_pct = statsB["slice_pct"], statsB["slice_range_pct"], statsB["slice_sd_pct"]
 
     # ------------- PRINT -------------
     print("\n=== N4 LOG-BIAS: Essential Stats (ROI) ===")
@@ -245,6 +589,69 @@ def main (VOL_A_NAME, VOL_B_NAME, MASK_A_NAME, MASK_B_NAME, OUTPUT_PREFIX):
     outB = push_sitk_image(logB_B, f"{OUTPUT_PREFIX}_LogBias_B", ref_node=nodeB)
     print(f"\nPushed bias fields: {outA.GetName()}, {outB.GetName()} (log-scale).")
 
+RESULT_FIELDS = ["pair", "volume", "plane", "mask", "n", "mad_pct", "iqr_half_pct",
+                 "pct_above_0.1", "pct_above_0.2", "slice_range_pct", "slice_sd_pct"]
+
+def main_batch(PAIRS, RESULTS_PATH=None, NUM_WORKERS=1, CACHE_DIR=None, THRESHOLDS=(0.1, 0.2), N4_ADAPTIVE=False):
+    """
+    Evaluate many (volumeA, volumeB, maskA, maskB) pairs in one run.
+
+    Each distinct volume and (mask, volume) export is prepared once, and the per-slice N4 of
+    every volume goes through a single worker pool and the bias-field cache. Writes one row
+    per pair and plane to RESULTS_PATH (.json for JSON, otherwise CSV) and returns the rows.
+    """
+    images, masks = {}, {}
+    for pair in PAIRS:
+        for vol_name, mask_name in ((pair[0], pair[2]), (pair[1], pair[3])):
+            if vol_name not in images:
+                images[vol_name] = get_sitk_image(vol_name)[0]
+            if (mask_name, vol_name) not in masks:
+                if mask_name:
+                    masks[(mask_name, vol_name)] = seg_to_mask_for_reference(mask_name, vol_name)[0]
+                else:
+                    masks[(mask_name, vol_name)] = volume_mask(images[vol_name])
+
+    keys = list(masks.keys())
+    fields = compute_biasfields_per_slice([(images[v], masks[(m, v)]) for m, v in keys],
+                                          workers=NUM_WORKERS, cache_dir=CACHE_DIR, adaptive=N4_ADAPTIVE,
+                                          bspline_mm=50.0, shrink_factor=2, conv=[50,50,30,20])
+    log_bias = dict(zip(keys, fields))
+
+    rows = []
+    for pair in PAIRS:
+        label = f"{pair[0]} | {pair[1]}"
+        for vol_name, mask_name in ((pair[0], pair[2]), (pair[1], pair[3])):
+            st = roi_statistics(log_bias[(mask_name, vol_name)], masks[(mask_name, vol_name)], THRESHOLDS)
+            row = {
+                "pair": label,
+                "volume": vol_name,
+                "plane": plane_from_name(vol_name),
+                "mask": mask_name or "otsu",
+                "n": st["n"],
+                "mad_pct": to_pct(st["mad"]),
+                "iqr_half_pct": to_pct(st["iqr_half"]),
+                "slice_range_pct": st["slice_range_pct"],
+                "slice_sd_pct": st["slice_sd_pct"],
+            }
+            for th in THRESHOLDS:
+                row[f"pct_above_{th}"] = st["pct_above"][th]
+            rows.append(row)
+            print(f"{label:40s} {row['plane'] or vol_name:>4s}: MAD ±{row['mad_pct']:.1f}%  "
+                  f"IQR/2 ±{row['iqr_half_pct']:.1f}%  drift {row['slice_range_pct']:.1f}%")
+
+    if RESULTS_PATH:
+        if RESULTS_PATH.lower().endswith(".json"):
+            with open(RESULTS_PATH, "w") as f:
+                json.dump(rows, f, indent=2)
+        else:
+            fieldnames = RESULT_FIELDS[:7] + [f"pct_above_{th}" for th in THRESHOLDS] + RESULT_FIELDS[-2:]
+            with open(RESULTS_PATH, "w", newline="") as f:
+                w = csv.DictWriter(f, fieldnames=fieldnames)
+                w.writeheader()
+                w.writerows(rows)
+        print(f"\nWrote {len(rows)} rows to {RESULTS_PATH}")
+    return rows
+
 # ----------------- Inputs & call -----------------
 try:
     volumeA
@@ -266,9 +673,47 @@ try:
     outputPrefix
 except NameError:
     outputPrefix = "N4Bias"
-
-if None in (volumeA, volumeB):
+try:
+    numWorkers
+except NameError:
+    numWorkers = 1
+try:
+    scriptPath
+except NameError:
+    scriptPath = None
+try:
+    cacheDir
+except NameError:
+    cacheDir = os.path.join(slicer.app.temporaryPath, "CompareBiasCache")
+try:
+    n4Adaptive
+except NameError:
+    n4Adaptive = False
+try:
+    benchmarkVolume
+except NameError:
+    benchmarkVolume = None
+try:
+    parityVolume
+except NameError:
+    parityVolume = None
+try:
+    pairs
+except NameError:
+    pairs = None
+try:
+    resultsPath
+except NameError:
+    resultsPath = None
+
+if benchmarkVolume:
+    benchmark_adaptive_n4(benchmarkVolume, maskA, workers=numWorkers)
+elif parityVolume:
+    check_worker_parity(parityVolume, maskA, workers=numWorkers, adaptive=n4Adaptive)
+elif pairs:
+    main_batch(pairs, resultsPath, numWorkers, cacheDir, N4_ADAPTIVE=n4Adaptive)
+elif None in (volumeA, volumeB):
     print("Error: Missing one or more inputs.")
-    print("Please define 'volumeA' and 'volumeB' before executing the script.")
+    print("Please define 'volumeA' and 'volumeB' (or 'pairs') before executing the script.")
 else:
-    main(volumeA, volumeB, maskA, maskB, outputPrefix)
+    main(volumeA, volumeB, maskA, maskB, outputPrefix, numWorkers, cacheDir, n4Adaptive)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Per-slice N4 bias field estimation with SimpleITK only (no Slicer), so it can run in
+spawned worker processes. Used by CompareBias.py's worker pool (its serial path runs the
+same functions in-file); tasks and results are plain NumPy arrays plus slice geometry, so
+they pickle without relying on SimpleITK image pickling. Keep n4_slice_bias identical to
+CompareBias.py's: CompareBias.check_worker_parity compares the two paths.
+"""
+import SimpleITK as sitk
+
+def adaptive_n4_config(slice_img, bspline_mm=50.0, conv=[50,50,30,20], fitting_levels=4,
+                       target_mm=4.0, min_px=32):
+    """
+    Pick shrink factor, control-point grid and fitting levels from slice size and spacing.
+
+    The shrink brings pixels to ~target_mm while keeping at least min_px pixels per side;
+    levels are dropped while the finest B-spline mesh would exceed half the shrunk pixels.
+    """
+    size = slice_img.GetSize()
+    spacing = slice_img.GetSpacing()
+    shrink = int(round(target_mm / min(spacing[0], spacing[1])))
+    shrink = max(1, min(shrink, min(size[0], size[1]) // min_px))
+
+    extent_mm = (size[0]*spacing[0], size[1]*spacing[1])
+    nx = max(4, int(round(extent_mm[0]/bspline_mm)))
+    ny = max(4, int(round(extent_mm[1]/bspline_mm)))
+
+    shrunk_px = min(size[0], size[1]) // shrink
+    levels = int(fitting_levels)
+    while levels > 1 and (max(nx, ny) - 3) * 2**(levels - 1) + 3 > shrunk_px // 2:
+        levels -= 1
+    return {"shrink_factor": shrink, "control_points": [nx, ny],
+            "fitting_levels": levels, "conv": list(conv[:levels])}
+
+def n4_slice_bias(slice_img, slice_mask, shrink_factor=2, conv=[50,50,30,20], bspline_mm=50.0, fitting_levels=4,
+                  adaptive=False, tol=1e-4, threads=1, record=None):
+    """
+    N4 log-bias of one 2D slice.
+
+    adaptive=True derives shrink factor, control points and levels from the slice (adaptive_n4_config)
+    and stops each level once N4's change in the bias estimate drops below 'tol' instead of 1e-7.
+    threads pins the N4 filter's ITK threads: its B-spline fit accumulates per-thread lattices,
+    so the result can depend on the thread count.
+    If 'record' is a dict, it receives the configuration and the iterations actually run per level.
+    """
+    control_points = None
+    convergence = 1e-7
+    if adaptive:
+        cfg = adaptive_n4_config(slice_img, bspline_mm=bspline_mm, conv=conv, fitting_levels=fitting_levels)
+        shrink_factor, conv, fitting_levels = cfg["shrink_factor"], cfg["conv"], cfg["fitting_levels"]
+        control_points = cfg["control_points"]
+        convergence = float(tol)
+
+    corrector = sitk.N4BiasFieldCorrectionImageFilter()
+    corrector.SetMaximumNumberOfIterations(conv)
+    corrector.SetConvergenceThreshold(convergence)
+    corrector.SetSplineOrder(3)
+    corrector.SetNumberOfThreads(max(1, int(threads)))
+    if hasattr(corrector, "SetNumberOfFittingLevels"):
+        corrector.SetNumberOfFittingLevels(int(fitting_levels))
+    if hasattr(corrector, "SetNumberOfControlPoints"):
+        if control_points is None:
+            size = slice_img.GetSize()
+            spacing = slice_img.GetSpacing()
+            extent_mm = (size[0]*spacing[0], size[1]*spacing[1])
+            nx = max(4, int(round(extent_mm[0]/bspline_mm)))
+            ny = max(4, int(round(extent_mm[1]/bspline_mm)))
+            control_points = [nx, ny]
+        corrector.SetNumberOfControlPoints(control_points)
+
+    iterations = [0] * int(fitting_levels)
+    if record is not None:
+        def count_iteration():
+            iterations[min(corrector.GetCurrentLevel(), len(iterations) - 1)] += 1
+        corrector.AddCommand(sitk.sitkIterationEvent, count_iteration)
+
+    shrink = [max(1, int(shrink_factor)), max(1, int(shrink_factor))]
+    sim   = sitk.Shrink(slice_img, shrink)
+    smask = sitk.Shrink(slice_mask, shrink)
+    sim   = sitk.Cast(sim, sitk.sitkFloat32)
+
+    _ = corrector.Execute(sim, smask)
+    log_bias = corrector.GetLogBiasFieldAsImage(slice_img)
+
+    if record is not None:
+        record.update(shrink_factor=int(shrink_factor), fitting_levels=int(fitting_levels),
+                      control_points=control_points, iterations=iterations)
+    return sitk.Cast(log_bias, sitk.sitkFloat32)
+
+def init_worker(num_threads):
+    """Process pool initializer: bound ITK threads per worker to avoid oversubscription."""
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(max(1, int(num_threads)))
+
+def slice_task(s2d, m2d, n4kw):
+    """Picklable N4 task for one 2D slice and its mask."""
+    geometry = (s2d.GetSpacing(), s2d.GetOrigin(), s2d.GetDirection())
+    return (sitk.GetArrayFromImage(s2d), sitk.GetArrayFromImage(m2d), geometry, n4kw)
+
+def _image_from_array(arr, geometry):
+    im = sitk.GetImageFromArray(arr)
+    spacing, origin, direction = geometry
+    im.SetSpacing(spacing)
+    im.SetOrigin(origin)
+    im.SetDirection(direction)
+    return im
+
+def n4_slice_task(task):
+    """
+    Run n4_slice_bias on a slice_task.
+
+    Returns:
+        (ndarray, dict): The float32 log-bias array and the N4 record (configuration and iterations).
+    """
+    arr, mask_arr, geometry, n4kw = task
+    record = {}
+    logb = n4_slice_bias(_image_from_array(arr, geometry), _image_from_array(mask_arr, geometry),
+                         record=record, **n4kw)
+    return sitk.GetArrayFromImage(logb), record